@@ -2,7 +2,7 @@ from django import forms
 from django.contrib import admin
 from django.http import HttpResponseRedirect
 from django.utils.translation import ugettext_lazy as _
-from isle.models import Event, EventType, ZendeskData
+from isle.models import Event, EventType, ZendeskData, SyncRun
 from isle.utils import create_traces_for_event_type
 
 
@@ -30,13 +30,13 @@ class EventAdmin(RemoveDeleteActionMixin, admin.ModelAdmin):
 
     def make_active(self, request, queryset):
         selected = request.POST.getlist('_selected_action')
-        Event.objects.filter(id__in=selected).update(is_active=True)
+        Event.objects.filter(id__in=selected).update(is_active=True, data_hash='')
         return HttpResponseRedirect(request.get_full_path())
     make_active.short_description = _(u'Сделать доступным для оцифровки')
 
     def make_inactive(self, request, queryset):
         selected = request.POST.getlist('_selected_action')
-        Event.objects.filter(id__in=selected).update(is_active=False)
+        Event.objects.filter(id__in=selected).update(is_active=False, data_hash='')
         return HttpResponseRedirect(request.get_full_path())
     make_inactive.short_description = _(u'Сделать недоступным для оцифровки')
 
@@ -78,3 +78,22 @@ class EventTypeAdmin(RemoveDeleteActionMixin, admin.ModelAdmin):
 class ZerndeskDataAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
         return not ZendeskData.objects.exists()
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'started_at', 'duration', 'rows_read', 'inserted', 'updated', 'skipped',
+                    'deleted', 'http_calls', 'db_queries', 'errors')
+    list_filter = ('status', 'name')
+    date_hierarchy = 'started_at'
+    ordering = ('-started_at', )
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in SyncRun._meta.fields]
+
+    def duration(self, obj):
+        return obj.duration
+    duration.short_description = 'Длительность, с'
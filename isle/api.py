@@ -1,6 +1,16 @@
+import codecs
+import json
 import logging
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from threading import Lock
 from django.conf import settings
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from isle import journal
 
 
 class ApiError(Exception):
@@ -15,12 +25,130 @@ class BadApiResponse(ApiError):
     pass
 
 
+_sessions = {}
+_sessions_lock = Lock()
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+_json_delimiters = ',] \t\n\r'
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def iter_json_array(chunks):
+    """
+    инкрементальный разбор json-массива верхнего уровня из потока байт chunks: элементы отдаются по одному
+    по мере чтения, в памяти держится только текущий элемент и недочитанный остаток потока
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf, pos = '', 0
+    exhausted = False
+    # ожидаемый токен: начало массива, первый элемент или конец, элемент, разделитель или конец, конец потока
+    state = 'start'
+
+    def read(min_length):
+        nonlocal buf, exhausted
+        while not exhausted and len(buf) < min_length:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+                buf += decoder.decode(b'', final=True)
+            else:
+                buf += decoder.decode(chunk)
+
+    while True:
+        pos = _json_whitespace.match(buf, pos).end()
+        if pos == len(buf):
+            if exhausted:
+                if state == 'end':
+                    return
+                raise ValueError('Unexpected end of JSON array')
+            buf, pos = '', 0
+            read(1)
+            continue
+        char = buf[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError('JSON array expected')
+            state, pos = 'first', pos + 1
+        elif state == 'end':
+            raise ValueError('Extra data after JSON array')
+        elif char == ']' and state in ('first', 'next'):
+            state, pos = 'end', pos + 1
+        elif state == 'next':
+            if char != ',':
+                raise ValueError('Expecting "," delimiter in JSON array')
+            state, pos = 'item', pos + 1
+        else:
+            try:
+                item, end = _json_decoder.raw_decode(buf, pos)
+            except ValueError:
+                if exhausted:
+                    raise
+                end = None
+            # значение в конце буфера может быть обрезано, поэтому за ним должен быть еще хотя бы один символ,
+            # а за числом - разделитель: иначе "1." из "1.5" на границе кусков разобралось бы как 1
+            if end is None or not exhausted and (
+                    end == len(buf) or _is_number(item) and buf[end] not in _json_delimiters):
+                # элемент не дочитан: увеличиваем буфер вдвое, чтобы не разбирать его заново на каждом куске
+                buf, pos = buf[pos:], 0
+                read(len(buf) * 2)
+                continue
+            yield item
+            buf, pos = buf[end:], 0
+            state = 'next'
+
+
 class BaseApi:
     name = ''
     base_url = ''
     app_token = ''
     authorization = {}
     verify = True
+    # количество страниц ответа, запрашиваемых одновременно, при 0 или 1 страницы запрашиваются последовательно
+    parallel_pages = 0
+    # размер куска, которым читается ответ в make_streaming_request
+    stream_chunk_size = 64 * 1024
+
+    @classmethod
+    def get_session(cls):
+        """
+        общая для всех потоков сессия класса api, переиспользующая keep-alive соединения
+        """
+        session = _sessions.get(cls)
+        if session is None:
+            with _sessions_lock:
+                session = _sessions.get(cls)
+                if session is None:
+                    session = _sessions[cls] = cls.create_session()
+        return session
+
+    @classmethod
+    def create_session(cls):
+        """
+        сессия с пулом соединений: API_POOL_MAXSIZE соединений на хост (при API_POOL_BLOCK запросы сверх этого
+        количества ждут освобождения соединения) и повтором идемпотентных запросов при ошибках соединения
+        и ответах 502-504 до API_RETRIES раз с экспоненциальной задержкой
+        """
+        retry = Retry(
+            total=getattr(settings, 'API_RETRIES', 2),
+            backoff_factor=getattr(settings, 'API_RETRY_BACKOFF', 0.3),
+            status_forcelist=(502, 503, 504),
+            method_whitelist=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=getattr(settings, 'API_POOL_CONNECTIONS', 10),
+            pool_maxsize=getattr(settings, 'API_POOL_MAXSIZE', 10),
+            pool_block=getattr(settings, 'API_POOL_BLOCK', True),
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def update_kwargs(self, kwargs):
         """
@@ -35,34 +163,110 @@ class BaseApi:
             else:
                 kwargs[key] = item
 
+    def _prepare_kwargs(self, kwargs):
+        kwargs.setdefault('timeout', settings.CONNECTION_TIMEOUT)
+        self.update_kwargs(kwargs)
+        if not self.verify:
+            kwargs.setdefault('verify', False)
+
     def make_request(self, url, method='GET', **kwargs):
         """
-        итератор по всем страницам ответа
+        итератор по всем страницам ответа. Если у класса задан parallel_pages больше 1, то после первой
+        страницы, из которой становится известно количество страниц, остальные запрашиваются параллельно,
+        не более parallel_pages одновременно, но отдаются по порядку
         """
         url = '{}{}'.format(self.base_url, url)
+        self._prepare_kwargs(kwargs)
+        if self.parallel_pages > 1:
+            yield from self._make_parallel_request(url, method, kwargs)
+            return
+        page = 1
+        total_pages = None
+        while total_pages is None or page <= total_pages:
+            data, total_pages = self._get_page(self.get_session(), url, method, kwargs, page)
+            journal.add(http_calls=1)
+            yield data
+            page += 1
+
+    def _make_parallel_request(self, url, method, kwargs):
+        session = self.get_session()
+        data, total_pages = self._get_page(session, url, method, kwargs, 1)
+        journal.add(http_calls=1)
+        yield data
+        if total_pages < 2:
+            return
+        pages = iter(range(2, total_pages + 1))
+        futures = deque()
+        executor = ThreadPoolExecutor(max_workers=min(self.parallel_pages, total_pages - 1))
+        try:
+            for page in islice(pages, self.parallel_pages):
+                futures.append(executor.submit(self._get_page, session, url, method, kwargs, page))
+            while futures:
+                data, __ = futures.popleft().result()
+                journal.add(http_calls=1)
+                for page in islice(pages, 1):
+                    futures.append(executor.submit(self._get_page, session, url, method, kwargs, page))
+                yield data
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+    def make_streaming_request(self, url, method='GET', **kwargs):
+        """
+        итератор по элементам всех страниц ответа, каждая из которых - json-массив. Страницы запрашиваются
+        последовательно, а элементы разбираются по мере чтения ответа, так что в памяти одновременно
+        находится один элемент, а не вся страница
+        """
+        url = '{}{}'.format(self.base_url, url)
+        self._prepare_kwargs(kwargs)
+        session = self.get_session()
         page = 1
         total_pages = None
-        kwargs.setdefault('timeout', settings.CONNECTION_TIMEOUT)
-        self.update_kwargs(kwargs)
-        if not self.verify:
-            kwargs.setdefault('verify', False)
         while total_pages is None or page <= total_pages:
+            resp, total_pages = self._request_page(session, url, method, kwargs, page, stream=True)
+            journal.add(http_calls=1)
             try:
-                kwargs['params']['page'] = page
-                resp = requests.request(method, url, **kwargs)
-                assert resp.ok, 'status_code %s' % resp.status_code
-                total_pages = int(resp.headers['X-Pagination-Page-Count'])
-                yield resp.json()
-                page += 1
-            except (ValueError, TypeError, AssertionError):
+                yield from iter_json_array(resp.iter_content(self.stream_chunk_size))
+            except ValueError:
                 logging.exception('Unexpected %s response for url %s' % (self.name, url))
                 raise BadApiResponse
-            except KeyError:
-                logging.error('%s %s response has no header "X-Pagination-Page-Count"' % (self.name, url))
-                raise ApiError
-            except AssertionError:
+            except requests.RequestException:
                 logging.exception('%s connection error' % self.name)
                 raise ApiError
+            finally:
+                resp.close()
+            page += 1
+
+    def _get_page(self, session, url, method, kwargs, page):
+        """
+        запрос одной страницы, возвращает данные страницы и общее количество страниц
+        """
+        resp, total_pages = self._request_page(session, url, method, kwargs, page)
+        try:
+            return resp.json(), total_pages
+        except ValueError:
+            logging.exception('Unexpected %s response for url %s' % (self.name, url))
+            raise BadApiResponse
+
+    def _request_page(self, session, url, method, kwargs, page, **extra):
+        """
+        запрос одной страницы, возвращает ответ и общее количество страниц
+        """
+        kwargs = dict(kwargs, params=dict(kwargs.get('params') or {}, page=page), **extra)
+        try:
+            resp = session.request(method, url, **kwargs)
+            assert resp.ok, 'status_code %s' % resp.status_code
+            return resp, int(resp.headers['X-Pagination-Page-Count'])
+        except (ValueError, TypeError, AssertionError):
+            logging.exception('Unexpected %s response for url %s' % (self.name, url))
+            raise BadApiResponse
+        except KeyError:
+            logging.error('%s %s response has no header "X-Pagination-Page-Count"' % (self.name, url))
+            raise ApiError
+        except AssertionError:
+            logging.exception('%s connection error' % self.name)
+            raise ApiError
 
     def make_request_no_pagination(self, url, method='GET', **kwargs):
         """
@@ -70,12 +274,10 @@ class BaseApi:
         """
         if not url.startswith(('http://', 'https://')):
             url = '{}{}'.format(self.base_url, url)
-        kwargs.setdefault('timeout', settings.CONNECTION_TIMEOUT)
-        self.update_kwargs(kwargs)
-        if not self.verify:
-            kwargs.setdefault('verify', False)
+        self._prepare_kwargs(kwargs)
         try:
-            resp = requests.request(method, url, **kwargs)
+            resp = self.get_session().request(method, url, **kwargs)
+            journal.add(http_calls=1)
             assert resp.ok, 'status_code %s' % resp.status_code
             return resp.json()
         except (ValueError, TypeError, AssertionError):
@@ -93,7 +295,7 @@ class BaseApi:
 
     def health_check(self):
         try:
-            resp = requests.head(self.base_url)
+            resp = self.get_session().head(self.base_url)
             if resp.status_code < 400:
                 return 'ok'
             else:
@@ -108,13 +310,19 @@ class LabsApi(BaseApi):
     base_url = settings.LABS_URL.rstrip('/')
     authorization = {'params': {'app_token': getattr(settings, 'LABS_TOKEN', '')}}
     verify = False
+    parallel_pages = getattr(settings, 'LABS_PARALLEL_PAGES', 0)
 
-    def get_activities(self, date_min=None, date_max=None):
+    def get_activities(self, date_min=None, date_max=None, stream=False):
+        """
+        итератор по страницам активностей, при stream=True - по отдельным активностям
+        """
         params = {}
         if date_min:
             params['date_min'] = date_min
         if date_max:
             params['date_max'] = date_max
+        if stream:
+            return self.make_streaming_request('/api/v2/activity', params=params)
         return self.make_request('/api/v2/activity', params=params)
 
     def get_types(self):
@@ -129,6 +337,7 @@ class XLEApi(BaseApi):
     base_url = settings.XLE_URL.rstrip('/')
     authorization = {'params': {'app_token': getattr(settings, 'XLE_TOKEN', '')}}
     verify = False
+    parallel_pages = getattr(settings, 'XLE_PARALLEL_PAGES', 0)
 
     def update_kwargs(self, kwargs):
         super().update_kwargs(kwargs)
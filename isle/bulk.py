@@ -0,0 +1,159 @@
+import logging
+from itertools import chain, islice
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from isle import journal
+
+
+def chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def iter_batches(items, size):
+    """
+    ленивое разбиение итератора на пачки по size элементов, в отличие от chunks элементы не загружаются
+    в память заранее. Каждая пачка должна быть прочитана до конца до перехода к следующей
+    """
+    items = iter(items)
+    for first in items:
+        yield chain([first], islice(items, size - 1))
+
+
+def get_chunk_size(chunk_size=None):
+    return chunk_size or getattr(settings, 'BULK_UPSERT_CHUNK_SIZE', 1000)
+
+
+class UpsertResult:
+    """
+    Результат bulk_upsert: соответствие ключ -> id объекта, ключи созданных или обновленных объектов
+    и количество созданных, обновленных и оставшихся без изменений объектов
+    """
+    def __init__(self):
+        self.ids = {}
+        self.changed_keys = set()
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+
+    def __str__(self):
+        return 'inserted: {}, updated: {}, unchanged: {}'.format(self.inserted, self.updated, self.unchanged)
+
+
+def bulk_upsert(model, key_field, rows, chunk_size=None):
+    """
+    Массовое создание/обновление объектов модели по уникальному полю key_field.
+    rows - словарь значение ключа -> словарь значений остальных полей (для внешних ключей используются
+    имена вида activity_id). Существующие объекты загружаются пачками по ключам, отсутствующие создаются
+    через bulk_create, у существующих обновляются только изменившиеся поля, объекты без изменений
+    не затрагиваются. Все изменения выполняются в одной транзакции
+    """
+    chunk_size = get_chunk_size(chunk_size)
+    result = UpsertResult()
+    if not rows:
+        return result
+    fields = sorted(set().union(*rows.values()))
+    manager = model._base_manager
+    with transaction.atomic():
+        existing = {}
+        for keys in chunks(rows, chunk_size):
+            qs = manager.filter(**{'{}__in'.format(key_field): keys}).values('id', key_field, *fields)
+            for item in qs:
+                existing[item.pop(key_field)] = item
+        to_create = []
+        for key, values in rows.items():
+            current = existing.get(key)
+            if current is None:
+                to_create.append(model(**dict(values, **{key_field: key})))
+                result.changed_keys.add(key)
+                continue
+            result.ids[key] = current['id']
+            changed = {field: value for field, value in values.items() if current[field] != value}
+            if changed:
+                manager.filter(id=current['id']).update(**changed)
+                result.changed_keys.add(key)
+                result.updated += 1
+            else:
+                result.unchanged += 1
+        for objs in chunks(to_create, chunk_size):
+            manager.bulk_create(objs)
+            keys = [getattr(obj, key_field) for obj in objs]
+            result.ids.update(manager.filter(**{'{}__in'.format(key_field): keys}).values_list(key_field, 'id'))
+        result.inserted = len(to_create)
+    journal.add(inserted=result.inserted, updated=result.updated, skipped=result.unchanged)
+    logging.info('%s bulk upsert: %s', model.__name__, result)
+    return result
+
+
+def bulk_create_or_restore(model, fields, pairs, restore_values=None, chunk_size=None):
+    """
+    Создание объектов модели с мягким удалением (поле deleted) для пар значений полей fields, например,
+    ('event_id', 'user_id'). Удаленные объекты для этих пар восстанавливаются одним update (вместе с
+    restore_values), для остальных пар объекты создаются через bulk_create пачками. В Django 2.0 нет
+    ignore_conflicts, поэтому пачка, на которой возник конфликт уникальности, сохраняется построчно.
+    Возвращает количество созданных и восстановленных объектов
+    """
+    chunk_size = get_chunk_size(chunk_size)
+    manager = model._base_manager
+    first, second = fields
+    pairs = set(pairs)
+    created, restored = 0, 0
+    for chunk in chunks(pairs, chunk_size):
+        chunk = set(chunk)
+        deleted = manager.filter(**{
+            '{}__in'.format(first): {i[0] for i in chunk},
+            '{}__in'.format(second): {i[1] for i in chunk},
+            'deleted': True,
+        }).values_list('id', first, second)
+        deleted_ids = {}
+        for obj_id, first_value, second_value in deleted:
+            if (first_value, second_value) in chunk:
+                deleted_ids[(first_value, second_value)] = obj_id
+        if deleted_ids:
+            restored += manager.filter(id__in=deleted_ids.values()).update(deleted=False, **(restore_values or {}))
+        objs = [model(**{first: i[0], second: i[1]}) for i in chunk if i not in deleted_ids]
+        if not objs:
+            continue
+        try:
+            with transaction.atomic():
+                manager.bulk_create(objs)
+            created += len(objs)
+        except IntegrityError:
+            for obj in objs:
+                __, obj_created = manager.update_or_create(
+                    defaults=dict(restore_values or {}, deleted=False),
+                    **{first: getattr(obj, first), second: getattr(obj, second)}
+                )
+                created += int(obj_created)
+    journal.add(inserted=created, updated=restored)
+    return created, restored
+
+
+def bulk_set_related(through, fields, mapping, chunk_size=None, changed_keys=None):
+    """
+    Аналог related_manager.set для нескольких объектов сразу. through - промежуточная модель связи
+    many-to-many, fields - имена полей связи в ней, например, ('activity_id', 'author_id'), mapping -
+    словарь id объекта -> id связанных объектов. Текущие связи загружаются одним запросом на пачку объектов,
+    недостающие создаются через bulk_create, лишние удаляются одним запросом. Возвращает количество
+    созданных и удаленных связей. Если передано множество changed_keys, в него добавляются id объектов,
+    связи которых изменились
+    """
+    chunk_size = get_chunk_size(chunk_size)
+    first, second = fields
+    created, deleted = 0, 0
+    for keys in chunks(mapping, chunk_size):
+        required = {(key, value) for key in keys for value in mapping[key]}
+        with transaction.atomic():
+            qs = through.objects.filter(**{'{}__in'.format(first): keys}).values_list('id', first, second)
+            current = {(first_value, second_value): obj_id for obj_id, first_value, second_value in qs}
+            to_delete = [obj_id for pair, obj_id in current.items() if pair not in required]
+            if to_delete:
+                deleted += through.objects.filter(id__in=to_delete).delete()[0]
+            objs = [through(**{first: pair[0], second: pair[1]}) for pair in required if pair not in current]
+            through.objects.bulk_create(objs)
+            created += len(objs)
+            if changed_keys is not None:
+                changed_keys.update(pair[0] for pair in required.symmetric_difference(current))
+    journal.add(inserted=created, deleted=deleted)
+    return created, deleted
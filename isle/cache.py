@@ -1,3 +1,4 @@
+import time
 from collections import Iterable
 from django.core.cache import caches
 
@@ -65,32 +66,87 @@ class BaseCache:
 
 def get_user_available_contexts(user):
     """
-    контексты, в которых у пользователя есть права ассистента
+    контексты, в которых у пользователя есть права ассистента. Права проверяются только для контекстов,
+    в которых у пользователя есть роль по индексу политик casbin, или для всех контекстов, если индекс
+    не может определить кандидатов
     """
+    from isle.casbin import get_user_context_index
     from isle.models import Context
-    uuids = set(Context.objects.values_list('uuid', flat=True))
-    uuid_cache_key = {UserContextAssistantCache().get_cache_key(user, ctx): ctx for ctx in uuids}
+    candidates = get_user_context_index().get_contexts(user.unti_id) if user.unti_id else set()
+    if candidates is None:
+        uuids = set(Context.objects.values_list('uuid', flat=True))
+    elif not candidates:
+        return []
+    else:
+        uuids = set(Context.objects.filter(uuid__in=candidates).values_list('uuid', flat=True))
+    user_cache = UserContextAssistantCache()
+    user_cache.load_generations(uuids)
+    uuid_cache_key = {user_cache.get_cache_key(user, ctx): ctx for ctx in uuids}
     results = DEFAULT_CACHE.get_many(uuid_cache_key.keys())
     results = {uuid_cache_key[k]: v for k, v in results.items()}
     not_found_ctxs = uuids - set(results.keys())
     for ctx in not_found_ctxs:
-        results[ctx] = UserContextAssistantCache().get(user, ctx)
+        results[ctx] = user_cache.get(user, ctx)
     return [i[0] for i in results.items() if i[1]]
 
 
 class UserContextAssistantCache(BaseCache):
+    """
+    Кэш прав ассистента пользователя в контексте. В ключ входит поколение контекста, так что сброс прав всех
+    пользователей в контексте - это одна операция увеличения поколения, после которой старые ключи
+    перестают использоваться и вытесняются из кэша
+    """
     KEY_PART = 'v%s:ctx-assistant'
+    GENERATION_KEY_PART = 'ctx-assistant-gen'
 
     def __init__(self):
         from .casbin import get_current_enforcer_and_version
         __, version = get_current_enforcer_and_version()
         self.KEY_PART = self.KEY_PART % version
+        self._generations = {}
+
+    @classmethod
+    def get_generation_key(cls, ctx):
+        return '{}:{}'.format(cls.GENERATION_KEY_PART, ctx)
+
+    def load_generations(self, contexts):
+        """
+        получение поколений для нескольких контекстов за один запрос к кэшу. Если поколения для контекста
+        еще нет (или оно было вытеснено), оно создается со значением, основанным на текущем времени, чтобы
+        не совпасть ни с одним из использованных ранее
+        """
+        keys = {self.get_generation_key(ctx): ctx for ctx in contexts if ctx not in self._generations}
+        if not keys:
+            return
+        found = DEFAULT_CACHE.get_many(keys.keys())
+        missing = [key for key in keys if key not in found]
+        if missing:
+            for key in missing:
+                DEFAULT_CACHE.add(key, int(time.time() * 1000), timeout=None)
+            found.update(DEFAULT_CACHE.get_many(missing))
+        for key, ctx in keys.items():
+            self._generations[ctx] = found.get(key, 0)
+
+    def get_generation(self, ctx):
+        self.load_generations([ctx])
+        return self._generations[ctx]
+
+    @classmethod
+    def discard_context(cls, ctx):
+        """
+        сброс закэшированных прав всех пользователей в контексте
+        """
+        try:
+            DEFAULT_CACHE.incr(cls.get_generation_key(ctx))
+        except ValueError:
+            # поколения нет в кэше, при следующем обращении будет создано новое
+            pass
 
     def create_value(self, *args):
         return args[0].is_assistant_for_context(args[1])
 
     def transform_args(self, *args):
-        return [args[0].id, args[1]]
+        return [self.get_generation(args[1]), args[0].id, args[1]]
 
     def set_many(self, arg_value_list):
         result = {self.get_cache_key(*item[0]): item[1] for item in arg_value_list}
@@ -1,15 +1,14 @@
 import logging
-from threading import local
+import re
+import time
+from threading import Lock
+from django.conf import settings
 from casbin import persist
 from casbin.enforcer import Enforcer
 from casbin.model import Model
 from casbin.persist.adapter import Adapter
 from .models import CasbinData
 
-_thread_locals = local()
-LOCAL_ENFORCER_KEY = '__local_casbin_enforcer'
-LOCAL_MODEL_VERSION_KEY = '__local_casbin_model_version'
-
 
 class TextAdapter(Adapter):
     def __init__(self, policy):
@@ -22,26 +21,121 @@ class TextAdapter(Adapter):
             persist.load_policy_line(line.strip(), model)
 
 
+def build_enforcer(data):
+    try:
+        m = Model()
+        m.load_model_from_text(data.model)
+        return Enforcer(m, TextAdapter(data.policy))
+    except Exception:
+        logging.exception('Failed to get enforcer')
+        return False
+
+
+class UserContextIndex:
+    """
+    Обратный индекс unti_id -> множество контекстов, в которых у пользователя есть роль или право, построенный
+    по строкам вида "g, unti_id, role, context" и "p, unti_id, context, ..." политик casbin. Используется как
+    список контекстов-кандидатов, права в которых затем проверяются enforcer'ом, вместо перебора всех контекстов.
+    Если модель сопоставляет домены функциями (keyMatch, regexMatch и т.п.), в политиках есть шаблоны контекстов,
+    роли без контекста ("g, unti_id, role") или наследование ролей ("g, role_a, role_b, context"), кандидатов по
+    индексу определить нельзя, и get_contexts возвращает None - нужно проверять все контексты. Индекс не
+    изменяется после построения, при изменении политик строится новый
+    """
+    MATCHING_FUNCTIONS = ('keyMatch', 'regexMatch', 'globMatch', 'ipMatch', 'domainMatch')
+    CONTEXT_RE = re.compile(r'^[\w-]+$')
+
+    def __init__(self, policy=None, model=None):
+        self._grants = {}
+        self.full_scan = any(name in (model or '') for name in self.MATCHING_FUNCTIONS)
+        for line in (policy or '').splitlines():
+            parts = tuple(i.strip() for i in line.split(','))
+            if parts[0] == 'g':
+                if len(parts) != 4 or not parts[1].isdigit():
+                    self.full_scan = True
+                    continue
+                unti_id, ctx = parts[1], parts[3]
+            elif parts[0] == 'p' and len(parts) >= 3:
+                if not parts[1].isdigit():
+                    # права ролей, пользователи получают их через строки g
+                    continue
+                unti_id, ctx = parts[1], parts[2]
+            else:
+                continue
+            if not self.CONTEXT_RE.match(ctx):
+                self.full_scan = True
+            self._grants.setdefault(unti_id, set()).add(ctx)
+
+    def get_contexts(self, unti_id):
+        """
+        контексты-кандидаты пользователя или None, если проверять нужно все контексты
+        """
+        if self.full_scan:
+            return None
+        return set(self._grants.get(str(unti_id), ()))
+
+    def get_unti_ids(self):
+        return set(self._grants)
+
+
+class EnforcerRegistry:
+    """
+    Общий для всех потоков процесса enforcer. Состояние (версия модели, контрольная сумма, enforcer, индекс
+    контекстов пользователей) заменяется целиком, поэтому читающие потоки всегда видят согласованные данные.
+    Не чаще, чем раз в CASBIN_ENFORCER_CHECK_INTERVAL секунд, версия и контрольная сумма сверяются с CasbinData,
+    и при их изменении enforcer пересобирается, так что изменения политик, полученные другими процессами,
+    подхватываются без рестарта
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._state = None
+        self._checked_at = 0
+
+    @property
+    def check_interval(self):
+        return getattr(settings, 'CASBIN_ENFORCER_CHECK_INTERVAL', 5)
+
+    def get(self):
+        state = self._state
+        if state is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return state
+        with self._lock:
+            if self._state is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._state
+            current = CasbinData.objects.order_by('id').values_list('model_version', 'checksum').first()
+            version, checksum = current or (0, '')
+            if self._state is None or self._state[:2] != (version, checksum):
+                self._swap(CasbinData.objects.order_by('id').first())
+            self._checked_at = time.monotonic()
+            return self._state
+
+    def swap(self, data):
+        """
+        немедленная замена enforcer'а, например, после обновления CasbinData в текущем процессе
+        """
+        with self._lock:
+            self._swap(data)
+            self._checked_at = time.monotonic()
+
+    def _swap(self, data):
+        if data is None:
+            self._state = (0, '', False, UserContextIndex())
+            return
+        enforcer = build_enforcer(data)
+        self._state = (data.model_version, data.checksum, enforcer, UserContextIndex(data.policy, data.model))
+
+
+enforcer_registry = EnforcerRegistry()
+
+
 def get_current_enforcer_and_version():
-    version = getattr(_thread_locals, LOCAL_MODEL_VERSION_KEY, None)
-    enforcer = getattr(_thread_locals, LOCAL_ENFORCER_KEY, None)
-    if version is None or enforcer is None:
-        data = CasbinData.objects.order_by('id').first()
-        if version is None:
-            version = data and data.model_version or 0
-            setattr(_thread_locals, LOCAL_MODEL_VERSION_KEY, version)
-        if enforcer is None:
-            try:
-                m = Model()
-                m.load_model_from_text(data.model)
-                enforcer = Enforcer(m, TextAdapter(data.policy))
-            except Exception:
-                logging.exception('Failed to get enforcer')
-                enforcer = False
-            setattr(_thread_locals, LOCAL_ENFORCER_KEY, enforcer)
+    version, __, enforcer, __ = enforcer_registry.get()
     return enforcer, version
 
 
+def get_user_context_index():
+    return enforcer_registry.get()[3]
+
+
 def enforce(sub, ctx, obj_type, action):
     try:
         enforcer, __ = get_current_enforcer_and_version()
@@ -51,3 +145,25 @@ def enforce(sub, ctx, obj_type, action):
     except Exception:
         logging.exception('Enforcer failed')
         return False
+
+
+def enforce_many(requests):
+    """
+    проверка нескольких запросов (sub, ctx, obj_type, action) одним и тем же enforcer'ом, возвращает список
+    результатов в порядке запросов
+    """
+    try:
+        enforcer, __ = get_current_enforcer_and_version()
+    except Exception:
+        logging.exception('Enforcer failed')
+        enforcer = False
+    if not enforcer:
+        return [False] * len(requests)
+    result = []
+    for request in requests:
+        try:
+            result.append(enforcer.enforce(*request))
+        except Exception:
+            logging.exception('Enforcer failed')
+            result.append(False)
+    return result
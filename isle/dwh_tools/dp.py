@@ -1,33 +1,31 @@
 from isle.models import UpdateTimes, MetaModel, DpCompetence
-from .utils import get_dwh_connect, change_update_time
+from .utils import dwh_connection, change_update_time, iter_rows, changed_keys_join
 
 
 @change_update_time(UpdateTimes.METAMODELS)
 def update_metamodels(dt=None):
-    db = get_dwh_connect('dp')
-    cur = db.cursor()
-    query = "select uuid, guid, title from model"
-    if dt:
-        query = "{query} where createDt >= '{dt}' or dt >= '{dt}'".format(query=query, dt=dt)
-    cur.execute(query)
-    data = cur.fetchall()
-    for item in data:
-        MetaModel.objects.update_or_create(uuid=item[0], defaults={
-            'guid': item[1],
-            'title': item[2],
-        })
+    with dwh_connection('dp') as db:
+        query = "select M.uuid, M.guid, M.title from model M"
+        params = None
+        if dt:
+            join, params = changed_keys_join('M.id', dt, ('M.id', 'model M', 'M'))
+            query = '{} {}'.format(query, join)
+        for item in iter_rows(db, query, params):
+            MetaModel.objects.update_or_create(uuid=item[0], defaults={
+                'guid': item[1],
+                'title': item[2],
+            })
 
 
 @change_update_time(UpdateTimes.COMPETENCES)
 def update_competences(dt=None):
-    db = get_dwh_connect('dp')
-    cur = db.cursor()
-    query = "select uuid, title from competence"
-    if dt:
-        query = "{query} where createDt >= '{dt}' or dt >= '{dt}'".format(query=query, dt=dt)
-    cur.execute(query)
-    data = cur.fetchall()
-    for item in data:
-        DpCompetence.objects.update_or_create(uuid=item[0], defaults={
-            'title': item[1],
-        })
+    with dwh_connection('dp') as db:
+        query = "select C.uuid, C.title from competence C"
+        params = None
+        if dt:
+            join, params = changed_keys_join('C.id', dt, ('C.id', 'competence C', 'C'))
+            query = '{} {}'.format(query, join)
+        for item in iter_rows(db, query, params):
+            DpCompetence.objects.update_or_create(uuid=item[0], defaults={
+                'title': item[1],
+            })
@@ -0,0 +1,101 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from django.conf import settings
+from django.db import connection
+from isle import journal
+from .dp import update_metamodels, update_competences
+from .labs import update_events, update_contexts, update_event_contexts, update_event_types, \
+    update_event_type_connections, update_authors, update_event_authors, update_event_structure
+from .pt import update_pt_teams
+from .xle import update_event_entries, update_run_enrollments
+
+
+class SyncStep:
+    """
+    Шаг синхронизации с DWH: функция импорта и имена шагов, которые должны успешно завершиться до ее запуска
+    """
+    STATUS_OK = 'ok'
+    STATUS_FAILED = 'failed'
+    STATUS_SKIPPED = 'skipped'
+
+    def __init__(self, name, func, depends_on=()):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.status = None
+        self.elapsed = None
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.func()
+            self.status = self.STATUS_OK
+        except Exception:
+            logging.exception('DWH sync step %s failed', self.name)
+            self.status = self.STATUS_FAILED
+        finally:
+            self.elapsed = time.monotonic() - start
+            # у каждого потока свое соединение с базой, закрываем его, чтобы оно не осталось висеть
+            connection.close()
+        return self
+
+
+def get_sync_steps():
+    steps = [
+        SyncStep('metamodels', update_metamodels),
+        SyncStep('competences', update_competences),
+        SyncStep('events', update_events),
+        SyncStep('contexts', update_contexts),
+        SyncStep('event_contexts', update_event_contexts, ('events', 'contexts')),
+        SyncStep('event_types', update_event_types),
+        SyncStep('event_type_connections', update_event_type_connections, ('events', 'event_types')),
+        SyncStep('authors', update_authors, ('events', )),
+        SyncStep('event_authors', update_event_authors, ('events', )),
+        SyncStep('event_structure', update_event_structure, ('events', 'metamodels', 'competences')),
+        SyncStep('event_entries', update_event_entries, ('events', )),
+        SyncStep('run_enrollments', update_run_enrollments, ('events', )),
+    ]
+    if settings.ENABLE_PT_TEAMS:
+        steps.append(SyncStep('pt_teams', update_pt_teams, ('contexts', )))
+    return steps
+
+
+def run_sync_steps(steps, workers=None, on_finish=None):
+    """
+    Запуск шагов синхронизации в пуле потоков: шаг запускается, как только успешно завершились все шаги,
+    от которых он зависит, независимые шаги выполняются параллельно. Шаги, зависящие от упавших,
+    пропускаются. on_finish вызывается для каждого завершенного или пропущенного шага
+    """
+    workers = workers or getattr(settings, 'DWH_SYNC_WORKERS', 4)
+    names = {step.name for step in steps}
+    pending = list(steps)
+    finished = {}
+    running = set()
+
+    def notify(step):
+        finished[step.name] = step
+        if on_finish:
+            on_finish(step)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            changed = True
+            while changed:
+                changed = False
+                for step in list(pending):
+                    depends_on = [i for i in step.depends_on if i in names]
+                    if any(i in finished and finished[i].status != SyncStep.STATUS_OK for i in depends_on):
+                        pending.remove(step)
+                        step.status = SyncStep.STATUS_SKIPPED
+                        notify(step)
+                        changed = True
+                    elif all(i in finished for i in depends_on):
+                        pending.remove(step)
+                        running.add(executor.submit(journal.wrap(step.run)))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                notify(future.result())
+    return steps
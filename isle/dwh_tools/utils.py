@@ -1,9 +1,19 @@
+import atexit
 import logging
+import pickle
+import tempfile
+from contextlib import contextmanager
+from threading import Lock
 from django.conf import settings
 from django.utils import timezone
 import MySQLdb
+import MySQLdb.cursors
+from isle import journal
 from isle.models import UpdateTimes
 
+# поля времени создания и изменения строк в таблицах DWH
+DELTA_COLUMNS = ('createDT', 'dt')
+
 
 def get_dwh_connect(database):
     return MySQLdb.connect(
@@ -16,6 +26,159 @@ def get_dwh_connect(database):
     )
 
 
+class DwhConnectionPool:
+    """
+    Пул соединений с одной из баз DWH. Перед выдачей соединение из пула проверяется через ping, мертвые
+    соединения закрываются. В пуле хранится не более DWH_POOL_SIZE свободных соединений, лишние закрываются
+    """
+    def __init__(self, database):
+        self.database = database
+        self._idle = []
+        self._lock = Lock()
+
+    @property
+    def size(self):
+        return getattr(settings, 'DWH_POOL_SIZE', 4)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                db = self._idle.pop() if self._idle else None
+            if db is None:
+                return get_dwh_connect(self.database)
+            try:
+                db.ping()
+                return db
+            except MySQLdb.Error:
+                self.close(db)
+
+    def release(self, db):
+        try:
+            # завершение транзакции, чтобы при следующем использовании соединения не читался старый снимок данных
+            db.rollback()
+        except MySQLdb.Error:
+            self.close(db)
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(db)
+                return
+        self.close(db)
+
+    @staticmethod
+    def close(db):
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            self.close(db)
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def get_dwh_pool(database):
+    with _pools_lock:
+        if database not in _pools:
+            _pools[database] = DwhConnectionPool(database)
+        return _pools[database]
+
+
+@contextmanager
+def dwh_connection(database):
+    """
+    соединение с базой DWH из пула. Если при работе с соединением произошла ошибка, оно закрывается,
+    а не возвращается в пул
+    """
+    pool = get_dwh_pool(database)
+    db = pool.acquire()
+    try:
+        yield db
+    except BaseException:
+        pool.close(db)
+        raise
+    pool.release(db)
+
+
+@atexit.register
+def close_dwh_connections():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
+def fetch_rows(db, query, params=None, batch_size=None):
+    """
+    выполнение запроса на серверном (небуферизованном) курсоре. Результат сначала целиком читается с сервера
+    пачками по DWH_FETCH_BATCH_SIZE во временный файл (в каталоге DWH_SPOOL_DIR или системном временном
+    каталоге), курсор закрывается, и только затем пачки по одной отдаются генератором из файла. Так долгая
+    обработка пачки (запись в базу, запросы к SSO) не останавливает передачу результата, которую MySQL иначе
+    прерывает по net_write_timeout, а в памяти находится только текущая пачка. Соединение освобождается
+    до начала обработки, поэтому через него можно выполнять другие запросы
+    """
+    batch_size = batch_size or getattr(settings, 'DWH_FETCH_BATCH_SIZE', 5000)
+    with tempfile.TemporaryFile(dir=getattr(settings, 'DWH_SPOOL_DIR', None)) as spool:
+        batches = 0
+        cur = db.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                pickle.dump(rows, spool, pickle.HIGHEST_PROTOCOL)
+                batches += 1
+        finally:
+            cur.close()
+        spool.seek(0)
+        for __ in range(batches):
+            rows = pickle.load(spool)
+            journal.add(rows_read=len(rows))
+            yield rows
+
+
+def iter_rows(db, query, params=None, batch_size=None):
+    """
+    построчный обход результата запроса, выполненного через fetch_rows
+    """
+    for rows in fetch_rows(db, query, params=params, batch_size=batch_size):
+        yield from rows
+
+
+def changed_keys_join(key, dt, *sources, columns=DELTA_COLUMNS):
+    """
+    join с подзапросом ключей, измененных после водяной отметки dt. Источник - тройка (выражение ключа,
+    таблицы для from, псевдоним таблицы, изменения в которой отслеживаются). Для каждого источника и поля
+    времени строится отдельный select с единственным условием, и они объединяются через union, чтобы DWH
+    мог использовать индексы по полям времени вместо полного просмотра из-за условий с or.
+    Возвращает текст join'а для добавления к запросу и параметры
+    """
+    selects = []
+    for key_expr, tables, alias in sources:
+        for column in columns:
+            selects.append('select {} as id from {} where {}.{} >= %s'.format(key_expr, tables, alias, column))
+    return 'inner join ({}) DELTA on DELTA.id={}'.format(' union '.join(selects), key), [dt] * len(selects)
+
+
+def in_chunks(query, values, chunk_size=None):
+    """
+    разбиение запроса с условием in по большому списку значений на несколько запросов. В запросе на месте
+    списка должно быть {placeholders}, генерируются пары (запрос, параметры)
+    """
+    values = list(values)
+    chunk_size = chunk_size or getattr(settings, 'DWH_IN_CHUNK_SIZE', 1000)
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        yield query.format(placeholders=', '.join(['%s'] * len(chunk))), chunk
+
+
 def format_dt(dt):
     return dt.astimezone(timezone.pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
 
@@ -33,8 +196,9 @@ def change_update_time(update_key, pass_current_time=False):
             if pass_current_time:
                 add_kwargs['now'] = now
             kwargs.update(add_kwargs)
-            result = fn(*args, **kwargs)
-            UpdateTimes.set_last_update_for_event(update_key, now)
+            with journal.sync_journal('dwh:{}'.format(update_key), watermark_from=dt, watermark_to=now):
+                result = fn(*args, **kwargs)
+                UpdateTimes.set_last_update_for_event(update_key, now)
             return result
         return inner
     return wrapper
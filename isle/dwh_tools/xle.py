@@ -1,106 +1,105 @@
 import logging
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
+from isle.bulk import bulk_create_or_restore
 from isle.models import UpdateTimes, Event, EventEntry, Run, RunEnrollment, User
-from isle.utils import pull_sso_user
-from .utils import get_dwh_connect, change_update_time, parse_dt
+from isle.utils import pull_sso_users
+from .utils import dwh_connection, change_update_time, fetch_rows, iter_rows, parse_dt, changed_keys_join
 
 
 @change_update_time(UpdateTimes.DWH_CHECKINS)
 def update_event_entries(dt=None):
-    db = get_dwh_connect('xle')
-    cur = db.cursor()
-    query = 'select C.attendance, C.checkin, E.uuid, UI.untiID from checkin C ' \
-            'inner join event E on C.eventID=E.id ' \
-            'inner join user U on C.userID=U.id ' \
-            'inner join user_info UI on U.id=UI.userID'
-    if dt:
-        query = "{query} where C.id in (select checkinID from checkin_log where createDT >= '{dt}')".\
-            format(query=query, dt=dt)
-    cur.execute(query)
-    data = cur.fetchall()
-    event_uuid_to_id = dict(Event.objects.values_list('uid', 'id'))
-    user_unti_id_to_id = dict(User.objects.filter(unti_id__isnull=False).values_list('unti_id', 'id'))
-    failed_users = set()
-    existing = set(EventEntry.objects.values_list('event_id', 'user_id'))
-    for item in data:
-        if not (item[0] or item[1]):
-            continue
-        user_id = user_unti_id_to_id.get(item[3])
-        event_id = event_uuid_to_id.get(item[2])
-        if not user_id:
-            if item[3] in failed_users:
-                continue
-            else:
-                user = pull_sso_user(item[3])
-                if not user:
-                    failed_users.add(item[3])
+    with dwh_connection('xle') as db:
+        query = 'select C.attendance, C.checkin, E.uuid, UI.untiID from checkin C ' \
+                'inner join event E on C.eventID=E.id ' \
+                'inner join user U on C.userID=U.id ' \
+                'inner join user_info UI on U.id=UI.userID'
+        params = None
+        if dt:
+            join, params = changed_keys_join('C.id', dt, ('L.checkinID', 'checkin_log L', 'L'), columns=('createDT', ))
+            query = '{} {}'.format(query, join)
+        event_uuid_to_id = dict(Event.objects.values_list('uid', 'id'))
+        user_unti_id_to_id = dict(User.objects.filter(unti_id__isnull=False).values_list('unti_id', 'id'))
+        failed_users = set()
+        existing = set(EventEntry.objects.values_list('event_id', 'user_id'))
+        created, restored = 0, 0
+        for rows in fetch_rows(db, query, params):
+            new_pairs = set()
+            pull_sso_users({item[3] for item in rows if item[0] or item[1]}, user_unti_id_to_id, failed_users)
+            for item in rows:
+                if not (item[0] or item[1]):
                     continue
-                user_id = user.id
-                user_unti_id_to_id[item[3]] = user_id
-        if user_id and event_id and (event_id, user_id) not in existing:
-            EventEntry.all_objects.update_or_create(event_id=event_id, user_id=user_id, defaults={
-                'deleted': False
-            })
+                user_id = user_unti_id_to_id.get(item[3])
+                event_id = event_uuid_to_id.get(item[2])
+                if user_id and event_id and (event_id, user_id) not in existing:
+                    new_pairs.add((event_id, user_id))
+            batch_created, batch_restored = bulk_create_or_restore(
+                EventEntry, ('event_id', 'user_id'), new_pairs, restore_values={'timestamp': timezone.now()}
+            )
+            Event.touch_materials(pair[0] for pair in new_pairs)
+            existing.update(new_pairs)
+            created, restored = created + batch_created, restored + batch_restored
+        logging.info('EventEntry: %s created, %s restored', created, restored)
 
 
 @change_update_time(UpdateTimes.DWH_RUN_ENROLLMENTS)
 def update_run_enrollments(dt=None):
-    db = get_dwh_connect('xle')
-    cur = db.cursor()
-    query = "select R.uuid, UI.untiID from timetable T " \
-            "inner join run R on R.id=T.runID " \
-            "inner join user U on T.userID=U.id " \
-            "inner join user_info UI on U.id=UI.userID "
-    if dt:
-        query = "{query} where T.createDT  >= '{dt}'".format(query=query, dt=dt)
-    cur.execute(query)
-    data = cur.fetchall()
-    run_uuid_to_id = dict(Run.objects.values_list('uuid', 'id'))
-    user_unti_id_to_id = dict(User.objects.filter(unti_id__isnull=False).values_list('unti_id', 'id'))
-    failed_users = set()
-    existing = set(RunEnrollment.objects.values_list('run_id', 'user_id'))
-    for item in data:
-        user_id = user_unti_id_to_id.get(item[1])
-        run_id = run_uuid_to_id.get(item[0])
-        if not user_id:
-            if item[1] in failed_users:
-                continue
-            else:
-                user = pull_sso_user(item[1])
-                if not user:
-                    failed_users.add(item[1])
-                    continue
-                user_id = user.id
-                user_unti_id_to_id[item[1]] = user_id
-        if user_id and run_id and (run_id, user_id) not in existing:
-            RunEnrollment.all_objects.update_or_create(run_id=run_id, user_id=user_id, defaults={
-                'deleted': False,
-            })
+    with dwh_connection('xle') as db:
+        query = "select R.uuid, UI.untiID from timetable T " \
+                "inner join run R on R.id=T.runID " \
+                "inner join user U on T.userID=U.id " \
+                "inner join user_info UI on U.id=UI.userID "
+        params = None
+        if dt:
+            query = "{query} where T.createDT >= %s".format(query=query)
+            params = [dt]
+        run_uuid_to_id = dict(Run.objects.values_list('uuid', 'id'))
+        user_unti_id_to_id = dict(User.objects.filter(unti_id__isnull=False).values_list('unti_id', 'id'))
+        failed_users = set()
+        existing = set(RunEnrollment.objects.values_list('run_id', 'user_id'))
+        created, restored = 0, 0
+        for rows in fetch_rows(db, query, params):
+            new_pairs = set()
+            pull_sso_users({item[1] for item in rows}, user_unti_id_to_id, failed_users)
+            for item in rows:
+                user_id = user_unti_id_to_id.get(item[1])
+                run_id = run_uuid_to_id.get(item[0])
+                if user_id and run_id and (run_id, user_id) not in existing:
+                    new_pairs.add((run_id, user_id))
+            batch_created, batch_restored = bulk_create_or_restore(RunEnrollment, ('run_id', 'user_id'), new_pairs)
+            Event.touch_runs_materials(pair[0] for pair in new_pairs)
+            existing.update(new_pairs)
+            created, restored = created + batch_created, restored + batch_restored
+        logging.info('RunEnrollment: %s created, %s restored', created, restored)
 
 
 @change_update_time(UpdateTimes.DELETE_RUN_ENROLLMENTS, pass_current_time=True)
 def clear_deleted_run_enrollments(dt=None, now=None):
-    db = get_dwh_connect('xle')
-    cur = db.cursor()
-    query = "select R.uuid, UI.untiID from timetable T " \
-            "inner join run R on R.id=T.runID " \
-            "inner join user U on T.userID=U.id " \
-            "inner join user_info UI on U.id=UI.userID"
-    if dt:
-        query = "{query} where T.createDT  >= '{dt}'".format(query=query, dt=dt)
-    cur.execute(query)
-    data = cur.fetchall()
-    filter_dict = {'created__lt': now}
-    if dt:
-        filter_dict['created__gte'] = parse_dt(parse_datetime(dt))
-    qs = RunEnrollment.objects.exclude(created__isnull=True).filter(**filter_dict)
-    created_enrollments = {(i[0], i[1]): i[2] for i in qs.values_list('run__uuid', 'user__unti_id', 'id').iterator()}
-    ids = set()
-    for item in data:
-        if not item[1]:
-            continue
-        run_enrollment_id = created_enrollments.get((item[0], item[1]))
-        if run_enrollment_id:
-            ids.add(run_enrollment_id)
-    res = qs.exclude(id__in=ids).update(deleted=True)
-    logging.info('%s RunEnrollment entries marked as deleted', res)
+    with dwh_connection('xle') as db:
+        query = "select R.uuid, UI.untiID from timetable T " \
+                "inner join run R on R.id=T.runID " \
+                "inner join user U on T.userID=U.id " \
+                "inner join user_info UI on U.id=UI.userID"
+        params = None
+        if dt:
+            query = "{query} where T.createDT >= %s".format(query=query)
+            params = [dt]
+        filter_dict = {'created__lt': now}
+        if dt:
+            filter_dict['created__gte'] = parse_dt(parse_datetime(dt))
+        qs = RunEnrollment.objects.exclude(created__isnull=True).filter(**filter_dict)
+        created_enrollments = {
+            (i[0], i[1]): i[2] for i in qs.values_list('run__uuid', 'user__unti_id', 'id').iterator()
+        }
+        ids = set()
+        for item in iter_rows(db, query, params):
+            if not item[1]:
+                continue
+            run_enrollment_id = created_enrollments.get((item[0], item[1]))
+            if run_enrollment_id:
+                ids.add(run_enrollment_id)
+        to_delete = qs.exclude(id__in=ids)
+        run_ids = set(to_delete.values_list('run_id', flat=True))
+        res = to_delete.update(deleted=True)
+        Event.touch_runs_materials(run_ids)
+        logging.info('%s RunEnrollment entries marked as deleted', res)
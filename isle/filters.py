@@ -1,5 +1,5 @@
 import django_filters
-from isle.models import LabsUserResult, LabsTeamResult
+from isle.models import LabsUserResult, LabsTeamResult, SyncRun
 
 
 class LabsUserResultFilter(django_filters.FilterSet):
@@ -23,3 +23,13 @@ class LabsTeamResultFilter(django_filters.FilterSet):
 class StatisticsFilter(django_filters.FilterSet):
     unti_id = django_filters.NumberFilter(required=False, field_name='user__unti_id')
     leader_id = django_filters.CharFilter(required=False, field_name='user__leader_id')
+
+
+class SyncRunFilter(django_filters.FilterSet):
+    name = django_filters.CharFilter(required=False)
+    status = django_filters.CharFilter(required=False)
+    started_at = django_filters.IsoDateTimeFromToRangeFilter()
+
+    class Meta:
+        model = SyncRun
+        fields = []
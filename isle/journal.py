@@ -0,0 +1,110 @@
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+from functools import wraps
+from django.db import connection
+from django.utils import timezone
+
+_local = threading.local()
+# запуск может обновляться из нескольких потоков, если работа передана в пул через wrap
+_counters_lock = threading.Lock()
+
+
+def _get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def add(**counters):
+    """
+    увеличение счетчиков (rows_read, inserted, updated, skipped, deleted, http_calls, errors) текущего запуска
+    синхронизации в этом потоке. Вне sync_journal ничего не делает
+    """
+    stack = _get_stack()
+    if not stack:
+        return
+    run = stack[-1]
+    with _counters_lock:
+        for key, value in counters.items():
+            setattr(run, key, getattr(run, key) + value)
+
+
+def fail(message):
+    """
+    отметка текущего запуска синхронизации как неудачного для кода, который сам обрабатывает исключения
+    """
+    from isle.models import SyncRun
+    stack = _get_stack()
+    if not stack:
+        return
+    run = stack[-1]
+    with _counters_lock:
+        run.status = SyncRun.STATUS_FAILED
+        run.errors += 1
+        run.last_error = message
+
+
+def _count_queries(run):
+    def count_query(execute, sql, params, many, context):
+        with _counters_lock:
+            run.db_queries += 1
+        return execute(sql, params, many, context)
+    return count_query
+
+
+def wrap(fn):
+    """
+    привязка функции, которая будет выполнена в другом потоке (например, в ThreadPoolExecutor), к текущему
+    запуску синхронизации: счетчики и запросы к базе из этого потока попадут в тот же запуск. Вызывается
+    в потоке, где открыт sync_journal
+    """
+    stack = _get_stack()
+    if not stack:
+        return fn
+    run = stack[-1]
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        worker_stack = _get_stack()
+        worker_stack.append(run)
+        try:
+            with connection.execute_wrapper(_count_queries(run)):
+                return fn(*args, **kwargs)
+        finally:
+            worker_stack.pop()
+    return inner
+
+
+@contextmanager
+def sync_journal(name, watermark_from=None, watermark_to=None):
+    """
+    запись запуска синхронизации name в журнал SyncRun. Запросы к базе из текущего потока считаются
+    автоматически, остальные счетчики накапливаются через add и fail в коде синхронизации. Можно
+    использовать как декоратор
+    """
+    from isle.models import SyncRun
+    run = SyncRun.objects.create(name=name, started_at=timezone.now(), watermark_from=watermark_from,
+                                 watermark_to=watermark_to)
+
+    stack = _get_stack()
+    stack.append(run)
+    try:
+        with connection.execute_wrapper(_count_queries(run)):
+            yield run
+    except Exception:
+        run.status = SyncRun.STATUS_FAILED
+        run.errors += 1
+        run.last_error = traceback.format_exc()
+        raise
+    finally:
+        stack.pop()
+        if run.status == SyncRun.STATUS_RUNNING:
+            run.status = SyncRun.STATUS_OK
+        run.finished_at = timezone.now()
+        try:
+            run.save()
+        except Exception:
+            logging.exception('Failed to save sync run %s', name)
@@ -45,7 +45,7 @@ class Command(BaseCommand):
             if cnt % 10 == 0:
                 print('{}/{} activities'.format(cnt, len_activities))
             cnt += 1
-            Event.objects.filter(id__in=events).update(activity_id=a_id)
+            Event.objects.filter(id__in=events).update(activity_id=a_id, data_hash='')
 
     def fetch_authors(self):
         print('fetching authors')
@@ -58,7 +58,8 @@ class Command(BaseCommand):
                 authors = a.get('authors') or []
                 for author in authors:
                     if author.get('is_main'):
-                        Activity.objects.filter(uid=a.get('uuid')).update(main_author=author.get('title'))
+                        Activity.objects.filter(uid=a.get('uuid')).update(
+                            main_author=author.get('title'), data_hash='')
                         break
         except AssertionError as e:
             logging.error('assertion error' % e)
@@ -1,28 +1,27 @@
-from django.conf import settings
-from django.core.management.base import BaseCommand
-from isle.dwh_tools.dp import update_metamodels, update_competences
-from isle.dwh_tools.labs import update_events, update_contexts, update_event_contexts, update_event_types, \
-    update_event_type_connections, update_authors, update_event_authors, update_event_structure
-from isle.dwh_tools.pt import update_pt_teams
-from isle.dwh_tools.xle import update_event_entries, update_run_enrollments
+import time
+from django.core.management.base import BaseCommand, CommandError
+from isle.dwh_tools.sync import SyncStep, get_sync_steps, run_sync_steps
+from isle.dwh_tools.utils import close_dwh_connections
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **options):
-        update_metamodels()
-        update_competences()
-
-        update_events()
-        update_contexts()
-        update_event_contexts()
-        update_event_types()
-        update_event_type_connections()
-        update_authors()
-        update_event_authors()
-        update_event_structure()
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Количество шагов синхронизации, выполняемых одновременно')
 
-        update_event_entries()
-        update_run_enrollments()
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        try:
+            steps = run_sync_steps(get_sync_steps(), workers=options['workers'], on_finish=self.report)
+        finally:
+            close_dwh_connections()
+        self.stdout.write('Total: {:.1f}s'.format(time.monotonic() - start))
+        failed = [step.name for step in steps if step.status != SyncStep.STATUS_OK]
+        if failed:
+            raise CommandError('Failed or skipped steps: {}'.format(', '.join(failed)))
 
-        if settings.ENABLE_PT_TEAMS:
-            update_pt_teams()
+    def report(self, step):
+        if step.status == SyncStep.STATUS_SKIPPED:
+            self.stdout.write('{}: {}'.format(step.name, step.status))
+        else:
+            self.stdout.write('{}: {} in {:.1f}s'.format(step.name, step.status, step.elapsed))
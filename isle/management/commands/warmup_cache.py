@@ -1,39 +1,133 @@
+import json
+import os
+import tempfile
+import time
+from multiprocessing import Pool
 from django.core.cache import caches
 from django.core.management.base import BaseCommand
-from isle.cache import get_user_available_contexts, UserContextAssistantCache
-from isle.models import CasbinData, User, Context
+from django.db import connections
+from isle.cache import UserContextAssistantCache
+from isle.casbin import enforcer_registry, get_user_context_index
+from isle.models import User, Context, check_permissions
+
+_contexts = set()
+
+
+def init_worker(contexts):
+    global _contexts
+    _contexts = contexts
+
+
+def warmup_users(unti_ids):
+    """
+    заполнение кэша прав ассистента для пачки пользователей. Проверяются только контексты, в которых у
+    пользователя есть роль, все значения пачки записываются одним set_many
+    """
+    index = get_user_context_index()
+    user_cache = UserContextAssistantCache()
+    users = list(User.objects.filter(unti_id__in=unti_ids))
+    candidates = {}
+    for user in users:
+        contexts = index.get_contexts(user.unti_id)
+        candidates[user.id] = _contexts if contexts is None else contexts & _contexts
+    user_cache.load_generations(set().union(*candidates.values()))
+    values = []
+    for user in users:
+        permissions = check_permissions(user, candidates[user.id])
+        values.extend(((user, ctx), value) for ctx, value in permissions.items())
+    if values:
+        user_cache.set_many(values)
+    return unti_ids, len(values)
 
 
 class Command(BaseCommand):
+    """
+    Заполнение кэша прав ассистента для пользователей, у которых есть роли в политиках casbin. Пользователи
+    без ролей в кэш не попадают: для них get_user_available_contexts не обращается к кэшу. Пачки пользователей
+    обрабатываются в нескольких процессах, обработанные пачки дописываются в файл, так что прерванный
+    прогон продолжается с того же места, пока не изменились версия модели и контрольная сумма политик casbin
+    """
     help = 'Заполнение кэша пользовательских прав'
 
     def add_arguments(self, parser):
-        parser.add_argument('-n', type=int, default=500)
+        parser.add_argument('-n', type=int, default=500, help='Количество пользователей в пачке')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Количество процессов')
+        parser.add_argument('--checkpoint', default=os.path.join(tempfile.gettempdir(), 'isle_warmup_cache.json'),
+                            help='Файл с информацией об уже обработанных пользователях')
+        parser.add_argument('--reset', action='store_true', help='Не использовать сохраненный прогресс')
 
     def handle(self, *args, **options):
-        cache = caches['default']
-        contexts = list(Context.objects.values_list('uuid', flat=True))
-        casbin_data = CasbinData.objects.first()
-        if not casbin_data:
+        version, checksum, __, index = enforcer_registry.get()
+        if not version:
             return
-        policy = casbin_data.policy
-        users_with_groups = set()
-        for line in policy.splitlines():
-            line = line.strip()
-            if line and line.startswith('g'):
-                unti_id = int(line.split(',')[1].strip())
-                users_with_groups.add(unti_id)
-
-        values = {}
-        user_cache_cls = UserContextAssistantCache()
-        for i, user in enumerate(User.objects.exclude(unti_id__in=users_with_groups).iterator(), 1):
-            for ctx in contexts:
-                values[user_cache_cls.get_cache_key(user, ctx)] = False
-            if i % options['n'] == 0:
-                cache.set_many(values)
-                values = {}
-        if values:
-            cache.set_many(values)
-
-        for user in User.objects.filter(unti_id__in=users_with_groups).iterator():
-            get_user_available_contexts(user)
+        policy_key = {'version': version, 'checksum': checksum}
+        if index.full_scan:
+            # кандидатов по индексу не определить, права проверяются для всех пользователей
+            unti_ids = sorted(User.objects.filter(unti_id__isnull=False).values_list('unti_id', flat=True))
+        else:
+            unti_ids = sorted(int(i) for i in index.get_unti_ids() if i.isdigit())
+        done = set() if options['reset'] else self.load_checkpoint(options['checkpoint'], policy_key)
+        todo = [i for i in unti_ids if i not in done]
+        batches = [todo[i:i + options['n']] for i in range(0, len(todo), options['n'])]
+        contexts = set(Context.objects.values_list('uuid', flat=True))
+        self.stdout.write('Пользователей: {}, уже обработано: {}'.format(len(unti_ids), len(unti_ids) - len(todo)))
+
+        if options['processes'] > 1 and len(batches) > 1:
+            # соединения родительского процесса не должны использоваться дочерними
+            connections.close_all()
+            caches['default'].close()
+            with Pool(options['processes'], initializer=init_worker, initargs=(contexts, )) as pool:
+                self.process(pool.imap_unordered(warmup_users, batches), done, len(todo), policy_key, options)
+        else:
+            init_worker(contexts)
+            self.process(map(warmup_users, batches), done, len(todo), policy_key, options)
+
+    def process(self, results, done, total, policy_key, options):
+        start, processed, keys = time.time(), 0, 0
+        with self.open_checkpoint(options['checkpoint'], policy_key, done) as checkpoint:
+            for unti_ids, keys_number in results:
+                processed += len(unti_ids)
+                keys += keys_number
+                # в файл дописывается только обработанная пачка
+                checkpoint.write('{}\n'.format(json.dumps(list(unti_ids))))
+                checkpoint.flush()
+                elapsed = time.time() - start
+                self.stdout.write('{}/{} пользователей, {} ключей, {:.1f} пользователей/с'.format(
+                    processed, total, keys, processed / elapsed if elapsed else 0))
+        if os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+
+    @staticmethod
+    def load_checkpoint(path, policy_key):
+        """
+        unti_id пользователей, обработанных прогоном с теми же версией модели и контрольной суммой политик.
+        Первая строка файла - версия и контрольная сумма, каждая следующая - список unti_id одной пачки
+        """
+        done = set()
+        try:
+            with open(path) as f:
+                if json.loads(f.readline()) != policy_key:
+                    return set()
+                for line in f:
+                    try:
+                        done.update(json.loads(line))
+                    except ValueError:
+                        # строка, запись которой была прервана
+                        continue
+        except (OSError, ValueError):
+            return set()
+        return done
+
+    @staticmethod
+    def open_checkpoint(path, policy_key, done):
+        """
+        файл прогресса для дописывания пачек. Если уже обработанных пользователей нет, файл создается заново
+        """
+        if done:
+            f = open(path, 'a')
+            # последняя строка могла быть записана не полностью, новые пачки начинаются с новой строки
+            f.write('\n')
+            return f
+        f = open(path, 'w')
+        f.write('{}\n'.format(json.dumps(policy_key, sort_keys=True)))
+        return f
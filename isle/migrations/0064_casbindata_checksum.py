@@ -0,0 +1,27 @@
+# Generated by Django 2.0.7 on 2019-11-20 12:41
+
+import hashlib
+from django.db import migrations, models
+
+
+def set_checksum(apps, schema_editor):
+    CasbinData = apps.get_model('isle', 'CasbinData')
+    for item in CasbinData.objects.all():
+        checksum = hashlib.md5('{}\n{}'.format(item.model, item.policy).encode('utf8')).hexdigest()
+        CasbinData.objects.filter(id=item.id).update(checksum=checksum)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0063_auto_20191108_0257'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='casbindata',
+            name='checksum',
+            field=models.CharField(default='', max_length=32),
+        ),
+        migrations.RunPython(set_checksum, reverse_code=migrations.RunPython.noop),
+    ]
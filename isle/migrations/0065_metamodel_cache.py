@@ -0,0 +1,23 @@
+# Generated by Django 2.0.7 on 2019-11-25 10:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0064_casbindata_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metamodel',
+            name='data_hash',
+            field=models.CharField(default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='metamodel',
+            name='fetched_at',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.7 on 2019-11-26 11:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0065_metamodel_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='data_hash',
+            field=models.CharField(default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='data_hash',
+            field=models.CharField(default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.0.7 on 2019-11-28 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0066_activity_event_data_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=255, verbose_name='Синхронизация')),
+                ('status', models.CharField(choices=[('running', 'running'), ('ok', 'ok'), ('failed', 'failed')], default='running', max_length=15, verbose_name='Статус')),
+                ('started_at', models.DateTimeField(db_index=True, verbose_name='Начало')),
+                ('finished_at', models.DateTimeField(default=None, null=True, verbose_name='Окончание')),
+                ('watermark_from', models.DateTimeField(default=None, null=True, verbose_name='Изменения начиная с')),
+                ('watermark_to', models.DateTimeField(default=None, null=True, verbose_name='Новая отметка обновления')),
+                ('rows_read', models.PositiveIntegerField(default=0, verbose_name='Прочитано')),
+                ('inserted', models.PositiveIntegerField(default=0, verbose_name='Создано')),
+                ('updated', models.PositiveIntegerField(default=0, verbose_name='Обновлено')),
+                ('skipped', models.PositiveIntegerField(default=0, verbose_name='Без изменений')),
+                ('http_calls', models.PositiveIntegerField(default=0, verbose_name='Запросов к api')),
+                ('db_queries', models.PositiveIntegerField(default=0, verbose_name='Запросов к базе')),
+                ('errors', models.PositiveIntegerField(default=0, verbose_name='Ошибок')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Последняя ошибка')),
+            ],
+            options={
+                'verbose_name': 'Запуск синхронизации',
+                'verbose_name_plural': 'Журнал синхронизации',
+            },
+        ),
+    ]
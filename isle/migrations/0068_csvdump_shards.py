@@ -0,0 +1,23 @@
+# Generated by Django 2.0.7 on 2019-12-02 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0067_syncrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvdump',
+            name='shards_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='csvdump',
+            name='shards_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.7 on 2019-12-04 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0068_csvdump_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvdump',
+            name='cache_key',
+            field=models.CharField(db_index=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='materials_modified_at',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
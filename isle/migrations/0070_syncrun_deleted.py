@@ -0,0 +1,18 @@
+# Generated by Django 2.0.7 on 2019-12-05 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0069_export_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='deleted',
+            field=models.PositiveIntegerField(default=0, verbose_name='Удалено'),
+        ),
+    ]
@@ -12,6 +12,8 @@ from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.deconstruct import deconstructible
@@ -30,6 +32,20 @@ def check_permission(user, context, obj_type='file', action='upload'):
     return enforce(str(user.unti_id), context, obj_type, action)
 
 
+def check_permissions(user, contexts, obj_type='file', action='upload'):
+    """
+    проверка прав пользователя сразу в нескольких контекстах за один проход enforcer'а,
+    возвращает словарь uuid контекста -> результат проверки
+    """
+    from .casbin import enforce_many
+    contexts = set(filter(None, contexts))
+    if not user.unti_id or not contexts:
+        return dict.fromkeys(contexts, False)
+    contexts = list(contexts)
+    sub = str(user.unti_id)
+    return dict(zip(contexts, enforce_many([(sub, ctx, obj_type, action) for ctx in contexts])))
+
+
 class User(AbstractUser):
     second_name = models.CharField(max_length=50)
     icon = JSONField()
@@ -52,9 +68,28 @@ class User(AbstractUser):
     def get_full_name(self):
         return ' '.join(filter(None, [self.last_name, self.first_name]))
 
+    @staticmethod
+    def _get_context_uuid(context):
+        return context if isinstance(context, str) else context and context.uuid
+
     def is_assistant_for_context(self, context):
-        context_uuid = context if isinstance(context, str) else context and context.uuid
-        return check_permission(self, context_uuid)
+        context_uuid = self._get_context_uuid(context)
+        return self.is_assistant_for_contexts([context_uuid]).get(context_uuid, False)
+
+    def is_assistant_for_contexts(self, contexts):
+        """
+        права ассистента в нескольких контекстах, возвращает словарь uuid контекста -> bool. Результаты
+        запоминаются в объекте пользователя, т.е. для request.user - на время обработки запроса
+        """
+        uuids = {self._get_context_uuid(i) for i in contexts}
+        missing = [i for i in uuids if i and i not in self._context_permissions]
+        if missing:
+            self._context_permissions.update(check_permissions(self, missing))
+        return {i: self._context_permissions.get(i, False) for i in uuids}
+
+    @cached_property
+    def _context_permissions(self):
+        return {}
 
     def has_assistant_role(self):
         return bool(self.available_context_uuids)
@@ -95,6 +130,7 @@ class Activity(models.Model):
     main_author = models.CharField(max_length=500, default='')
     is_deleted = models.BooleanField(default=False, verbose_name=_(u'Удалено'))
     authors = models.ManyToManyField(Author)
+    data_hash = models.CharField(max_length=32, default='')
 
     def get_labs_link(self):
         return '{}/admin/activity/view/{}'.format(settings.LABS_URL.rstrip('/'), self.uid)
@@ -156,11 +192,35 @@ class Event(models.Model):
     activity = models.ForeignKey(Activity, on_delete=models.CASCADE, default=None, null=True)
     context = models.ForeignKey(Context, on_delete=models.SET_NULL, null=True, default=None)
     run = models.ForeignKey(Run, on_delete=models.CASCADE, null=True, default=None)
+    data_hash = models.CharField(max_length=32, default='')
+    # время последнего изменения материалов, результатов или структуры мероприятия, по нему проверяется
+    # актуальность готовых выгрузок
+    materials_modified_at = models.DateTimeField(null=True, default=None)
 
     class Meta:
         verbose_name = _(u'Событие')
         verbose_name_plural = _(u'События')
 
+    @classmethod
+    def touch_materials(cls, event_ids):
+        """
+        отметка изменения материалов мероприятий event_ids, после которой готовые выгрузки по ним
+        перестают переиспользоваться
+        """
+        event_ids = set(filter(None, event_ids))
+        if event_ids:
+            cls.objects.filter(id__in=event_ids).update(materials_modified_at=timezone.now())
+
+    @classmethod
+    def touch_runs_materials(cls, run_ids):
+        """
+        отметка изменения материалов всех мероприятий прогонов run_ids (например, при изменении записей
+        на прогон)
+        """
+        run_ids = set(filter(None, run_ids))
+        if run_ids:
+            cls.objects.filter(run_id__in=run_ids).update(materials_modified_at=timezone.now())
+
     def __str__(self):
         fmt = '%H:%M %d.%m.%Y'
         if self.dt_start and self.dt_end:
@@ -1009,6 +1069,8 @@ class MetaModel(models.Model):
     uuid = models.CharField(max_length=255, unique=True)
     guid = models.CharField(max_length=255)
     title = models.CharField(max_length=500)
+    data_hash = models.CharField(max_length=32, default='')
+    fetched_at = models.DateTimeField(null=True, default=None)
 
     def __str__(self):
         return self.title
@@ -1057,6 +1119,9 @@ class CSVDump(models.Model):
     datetime_ready = models.DateTimeField(null=True, blank=True)
     status = models.SmallIntegerField(choices=STATUSES, default=STATUS_ORDERED)
     meta_data = JSONField(null=True)
+    shards_total = models.PositiveIntegerField(default=0)
+    shards_done = models.PositiveIntegerField(default=0)
+    cache_key = models.CharField(max_length=32, default='', db_index=True)
 
     @classmethod
     def current_generations_for_user(cls, user):
@@ -1070,9 +1135,49 @@ class CSVDump(models.Model):
             datetime_ordered__gt=timezone.now() - timezone.timedelta(seconds=settings.TIME_TO_FAIL_CSV_GENERATION)
         ).count()
 
+    @staticmethod
+    def get_cache_key(meta_data, event_ids):
+        """
+        ключ выгрузки, одинаковый для выгрузок с одинаковыми параметрами по одному и тому же набору мероприятий
+        """
+        data = {
+            'meta': {key: str(value) for key, value in meta_data.items()},
+            'events': sorted(event_ids),
+        }
+        return hashlib.md5(json.dumps(data, sort_keys=True).encode('utf8')).hexdigest()
+
+    @classmethod
+    def get_cached(cls, cache_key, event_ids):
+        """
+        последняя готовая выгрузка с ключом cache_key, сгенерированная не раньше CSV_EXPORT_CACHE_TTL секунд
+        назад, если с момента ее заказа не менялись материалы ни одного из мероприятий event_ids. Переиспользованные
+        копии выгрузки сохраняют datetime_ready исходной, поэтому повторное использование не продлевает ее срок
+        """
+        ttl = getattr(settings, 'CSV_EXPORT_CACHE_TTL', 0)
+        if not ttl:
+            return None
+        dump = cls.objects.filter(
+            cache_key=cache_key,
+            status=cls.STATUS_COMPLETE,
+            datetime_ready__gt=timezone.now() - timezone.timedelta(seconds=ttl),
+        ).exclude(csv_file='').order_by('-datetime_ready').first()
+        if dump is None or Event.objects.filter(
+                id__in=event_ids, materials_modified_at__gte=dump.datetime_ordered).exists():
+            return None
+        return dump
+
     def get_download_link(self):
         return reverse('load_csv_dump', kwargs={'dump_id': self.id})
 
+    @property
+    def progress(self):
+        """
+        процент готовых частей выгрузки при параллельной генерации, None для генерации одной задачей
+        """
+        if not self.shards_total:
+            return None
+        return self.shards_done * 100 // self.shards_total
+
     def get_file_name(self):
         return '{}.{}'.format(self.header, self.csv_file.name.split('.')[-1] or self.meta_data.get('format', 'csv'))
 
@@ -1089,6 +1194,14 @@ class CasbinData(models.Model):
     model = models.TextField()
     policy = models.TextField()
     model_version = models.IntegerField(default=1)
+    checksum = models.CharField(max_length=32, default='')
+
+    @staticmethod
+    def get_checksum(model, policy):
+        """
+        контрольная сумма модели и политик, по которой процессы понимают, что их enforcer устарел
+        """
+        return hashlib.md5('{}\n{}'.format(model, policy).encode('utf8')).hexdigest()
 
 
 class PLEUserResult(models.Model):
@@ -1239,6 +1352,48 @@ class UpdateTimes(models.Model):
         cls.objects.update_or_create(event_type=event_type, defaults={'dt': dt})
 
 
+class SyncRun(models.Model):
+    """
+    Журнал запусков синхронизации данных: длительность, количество прочитанных и измененных строк,
+    запросов к api и к базе, ошибки
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_OK = 'ok'
+    STATUS_FAILED = 'failed'
+
+    name = models.CharField(max_length=255, db_index=True, verbose_name='Синхронизация')
+    status = models.CharField(max_length=15, default=STATUS_RUNNING, verbose_name='Статус', choices=(
+        (STATUS_RUNNING, STATUS_RUNNING),
+        (STATUS_OK, STATUS_OK),
+        (STATUS_FAILED, STATUS_FAILED),
+    ))
+    started_at = models.DateTimeField(db_index=True, verbose_name='Начало')
+    finished_at = models.DateTimeField(null=True, default=None, verbose_name='Окончание')
+    watermark_from = models.DateTimeField(null=True, default=None, verbose_name='Изменения начиная с')
+    watermark_to = models.DateTimeField(null=True, default=None, verbose_name='Новая отметка обновления')
+    rows_read = models.PositiveIntegerField(default=0, verbose_name='Прочитано')
+    inserted = models.PositiveIntegerField(default=0, verbose_name='Создано')
+    updated = models.PositiveIntegerField(default=0, verbose_name='Обновлено')
+    skipped = models.PositiveIntegerField(default=0, verbose_name='Без изменений')
+    deleted = models.PositiveIntegerField(default=0, verbose_name='Удалено')
+    http_calls = models.PositiveIntegerField(default=0, verbose_name='Запросов к api')
+    db_queries = models.PositiveIntegerField(default=0, verbose_name='Запросов к базе')
+    errors = models.PositiveIntegerField(default=0, verbose_name='Ошибок')
+    last_error = models.TextField(default='', blank=True, verbose_name='Последняя ошибка')
+
+    class Meta:
+        verbose_name = 'Запуск синхронизации'
+        verbose_name_plural = 'Журнал синхронизации'
+
+    def __str__(self):
+        return '{} {}'.format(self.name, self.started_at)
+
+    @property
+    def duration(self):
+        if self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+
+
 class EventAuthor(models.Model):
     SOURCE_EVENT = 'event'
     SOURCE_ACTIVITY = 'activity'
@@ -1307,3 +1462,70 @@ class DpTool(models.Model):
 
     def __str__(self):
         return self.title
+
+
+def _get_materials_event_ids(model, ids):
+    if model in (LabsUserResult, LabsTeamResult):
+        return model.objects.filter(id__in=ids).values_list('result__block__event_id', flat=True)
+    return model._base_manager.filter(id__in=ids).values_list('event_id', flat=True)
+
+
+def _get_through_target_ids(through, instance, model):
+    """
+    id объектов модели model, связанных с instance через промежуточную модель through
+    """
+    source_field = target_field = None
+    for field in through._meta.get_fields():
+        if not field.is_relation or not field.many_to_one:
+            continue
+        if field.related_model is model and target_field is None:
+            target_field = field
+        elif isinstance(instance, field.related_model) and source_field is None:
+            source_field = field
+    if source_field is None or target_field is None:
+        return []
+    return through.objects.filter(**{source_field.attname: instance.pk}).values_list(target_field.attname, flat=True)
+
+
+@receiver([post_save, post_delete], sender=EventMaterial)
+@receiver([post_save, post_delete], sender=EventTeamMaterial)
+@receiver([post_save, post_delete], sender=EventOnlyMaterial)
+@receiver([post_save, post_delete], sender=Team)
+@receiver([post_save, post_delete], sender=Summary)
+@receiver([post_save, post_delete], sender=EventEntry)
+def materials_changed(sender, instance, **kwargs):
+    Event.touch_materials([instance.event_id])
+
+
+@receiver([post_save, post_delete], sender=RunEnrollment)
+def run_enrollment_changed(sender, instance, **kwargs):
+    Event.touch_runs_materials([instance.run_id])
+
+
+@receiver([post_save, post_delete], sender=LabsUserResult)
+@receiver([post_save, post_delete], sender=LabsTeamResult)
+def result_changed(sender, instance, **kwargs):
+    Event.touch_materials(
+        LabsEventResult.objects.filter(id=instance.result_id).values_list('block__event_id', flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=LabsUserResult.circle_items.through)
+@receiver(m2m_changed, sender=LabsTeamResult.circle_items.through)
+@receiver(m2m_changed, sender=Team.users.through)
+@receiver(m2m_changed, sender=EventTeamMaterial.owners.through)
+@receiver(m2m_changed, sender=EventOnlyMaterial.owners.through)
+def materials_relations_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    изменение связей результатов и материалов с элементами колеса, пользователями и командами. При обратном
+    изменении (например, user.team_set.add) мероприятия определяются по pk_set, при обратной очистке
+    (user.team_set.clear) pk_set не передается, и затрагиваемые объекты берутся из промежуточной таблицы
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        Event.touch_materials(_get_materials_event_ids(type(instance), [instance.pk]))
+    elif pk_set:
+        Event.touch_materials(_get_materials_event_ids(model, pk_set))
+    elif action == 'pre_clear':
+        Event.touch_materials(_get_materials_event_ids(model, _get_through_target_ids(sender, instance, model)))
@@ -2,7 +2,7 @@ from django.utils.translation import ugettext_lazy as _
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from isle.api import SSOApi, ApiError
-from isle.models import User, Team, UserFile, PLEUserResult, EventOnlyMaterial, Trace, DTraceStatistics
+from isle.models import User, Team, UserFile, PLEUserResult, EventOnlyMaterial, Trace, DTraceStatistics, SyncRun
 from .utils import pull_sso_user
 
 
@@ -198,3 +198,13 @@ class DTraceStatisticsSerializer(serializers.ModelSerializer):
         model = DTraceStatistics
         fields = ['context', 'unti_id', 'leader_id', 'n_entry', 'n_run_entry', 'n_personal', 'n_team',
                   'n_event', 'updated_at']
+
+
+class SyncRunSerializer(serializers.ModelSerializer):
+    duration = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = SyncRun
+        fields = ['id', 'name', 'status', 'started_at', 'finished_at', 'duration', 'watermark_from', 'watermark_to',
+                  'rows_read', 'inserted', 'updated', 'skipped', 'deleted', 'http_calls', 'db_queries', 'errors',
+                  'last_error']
@@ -1,10 +1,17 @@
 import csv
+import io
+import json
 import logging
+import shutil
 import tempfile
+from celery import chord
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import F
 from django.utils import timezone
 import requests
+from isle.bulk import chunks
 from isle.celery import app
 from isle.kafka import send_object_info, KafkaActions
 from isle.models import Event, CSVDump, Activity, Context, LabsTeamResult, UserFile, PLEUserResult
@@ -12,16 +19,33 @@ from isle.utils import EventGroupMaterialsCSV, BytesCsvObjWriter, XLSWriter
 from isle.serializers import UserResultSerializer
 
 
+def get_events_csv_generator(event_ids, meta):
+    meta = dict(meta)
+    if meta['activity']:
+        meta['activity'] = Activity.objects.get(id=meta['activity'])
+    if meta['context']:
+        meta['context'] = Context.objects.get(id=meta['context'])
+    return EventGroupMaterialsCSV(Event.objects.filter(id__in=event_ids).order_by('id'), meta)
+
+
 @app.task
 def generate_events_csv(dump_id, event_ids, file_format, meta):
+    """
+    генерация выгрузки по мероприятиям. Если мероприятий больше CSV_EXPORT_SHARD_SIZE, список разбивается
+    на части, которые генерируются параллельно и собираются в один файл задачей merge_events_csv_shards
+    """
     CSVDump.objects.filter(id=dump_id).update(status=CSVDump.STATUS_IN_PROGRESS)
-    events = Event.objects.filter(id__in=event_ids).order_by('id')
+    event_ids = sorted(event_ids)
+    shard_size = getattr(settings, 'CSV_EXPORT_SHARD_SIZE', 0)
     try:
-        if meta['activity']:
-            meta['activity'] = Activity.objects.get(id=meta['activity'])
-        if meta['context']:
-            meta['context'] = Context.objects.get(id=meta['context'])
-        obj = EventGroupMaterialsCSV(events, meta)
+        if shard_size and len(event_ids) > shard_size:
+            shards = list(chunks(event_ids, shard_size))
+            CSVDump.objects.filter(id=dump_id).update(shards_total=len(shards), shards_done=0)
+            chord(
+                generate_events_csv_shard.s(dump_id, num, ids, file_format, meta) for num, ids in enumerate(shards)
+            )(merge_events_csv_shards.s(dump_id, file_format, meta))
+            return
+        obj = get_events_csv_generator(event_ids, meta)
         if file_format == 'xls':
             with tempfile.TemporaryFile() as f:
                 writer = XLSWriter(f)
@@ -40,6 +64,77 @@ def generate_events_csv(dump_id, event_ids, file_format, meta):
         CSVDump.objects.filter(id=dump_id).update(status=CSVDump.STATUS_ERROR)
 
 
+@app.task
+def generate_events_csv_shard(dump_id, shard_num, event_ids, file_format, meta):
+    """
+    генерация части выгрузки без заголовков. Часть сохраняется в хранилище, чтобы быть доступной воркеру,
+    который будет ее собирать, возвращается имя файла или None в случае ошибки
+    """
+    try:
+        obj = get_events_csv_generator(event_ids, meta)
+        if file_format == 'xls':
+            # строки для xlsx сохраняются в json, чтобы при сборке сохранились типы значений
+            b = io.BytesIO()
+            for line in obj.generate(with_headers=False):
+                b.write(json.dumps(list(line), default=str).encode('utf-8') + b'\n')
+            content, extension = b.getvalue(), 'jsonl'
+        else:
+            b = BytesCsvObjWriter('utf-8')
+            c = csv.writer(b, delimiter=';')
+            for line in obj.generate(with_headers=False):
+                c.writerow(list(map(str, line)))
+            content, extension = b.file.getvalue(), 'csv'
+        name = default_storage.save(
+            'csv-dumps/shards/{}_{}.{}'.format(dump_id, shard_num, extension), ContentFile(content)
+        )
+    except Exception:
+        logging.exception('Failed to generate events csv shard %s for dump %s', shard_num, dump_id)
+        CSVDump.objects.filter(id=dump_id).update(status=CSVDump.STATUS_ERROR)
+        return None
+    CSVDump.objects.filter(id=dump_id).update(shards_done=F('shards_done') + 1)
+    return name
+
+
+@app.task
+def merge_events_csv_shards(shard_files, dump_id, file_format, meta):
+    """
+    сборка частей выгрузки в один файл в порядке мероприятий: части csv дописываются друг за другом после
+    заголовков, строки частей xlsx записываются в одну таблицу. Файлы частей после сборки удаляются
+    """
+    try:
+        if None in shard_files or CSVDump.objects.filter(id=dump_id, status=CSVDump.STATUS_ERROR).exists():
+            CSVDump.objects.filter(id=dump_id).update(status=CSVDump.STATUS_ERROR)
+            return
+        headers = get_events_csv_generator([], meta).generate_headers()
+        with tempfile.TemporaryFile() as f:
+            if file_format == 'xls':
+                writer = XLSWriter(f)
+                writer.writerow(headers)
+                for name in shard_files:
+                    with default_storage.open(name, 'rb') as shard:
+                        for line in shard:
+                            writer.writerow(json.loads(line.decode('utf-8')))
+                writer.close()
+                save_result_file(dump_id, f, 'xlsx')
+            else:
+                b = BytesCsvObjWriter('utf-8')
+                csv.writer(b, delimiter=';').writerow(list(map(str, headers)))
+                f.write(b.file.getvalue())
+                for name in shard_files:
+                    with default_storage.open(name, 'rb') as shard:
+                        shutil.copyfileobj(shard, f)
+                save_result_file(dump_id, f, 'csv')
+    except Exception:
+        logging.exception('Failed to merge events csv shards for dump %s', dump_id)
+        CSVDump.objects.filter(id=dump_id).update(status=CSVDump.STATUS_ERROR)
+    finally:
+        for name in filter(None, shard_files):
+            try:
+                default_storage.delete(name)
+            except Exception:
+                logging.exception('Failed to delete csv shard %s', name)
+
+
 def save_result_file(dump_id, result_file, extension):
     csv_dump = CSVDump.objects.get(id=dump_id)
     csv_dump.csv_file.save('.{}'.format(extension), content=result_file)
@@ -8,9 +8,10 @@ from django.test import TestCase
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 import responses
-from isle.api import LabsApi, BaseApi, XLEApi
-from isle.models import Activity, Event, EventType, LabsEventBlock, LabsEventResult, User, EventEntry
-from isle.utils import refresh_events_data, update_event_entries
+from isle.api import LabsApi, BaseApi, XLEApi, iter_json_array
+from isle.models import Activity, Event, EventType, LabsEventBlock, LabsEventResult, User, EventEntry, SyncRun, \
+    EventAuthor
+from isle.utils import refresh_events_data, update_event_entries, reconcile_event_authors
 
 
 def load_test_data(file_name):
@@ -49,6 +50,47 @@ class TestPagination(TestCase):
             num_pages += 1
         self.assertEqual(num_pages, 2)
 
+    @responses.activate
+    def test_parallel_pagination(self):
+        def return_val(request):
+            params = dict(parse_qsl(urlparse(request.url).query))
+            headers = {'X-Pagination-Page-Count': '5', 'Content-Type': 'application/json'}
+            return 200, headers, json.dumps({'page': int(params['page'])})
+
+        responses.add_callback(
+            responses.GET, 'http://example.com/', callback=return_val
+        )
+
+        with patch.object(TestApi, 'parallel_pages', 2):
+            pages = [data['page'] for data in TestApi().make_request('/')]
+        self.assertEqual(pages, [1, 2, 3, 4, 5])
+        self.assertEqual(len(responses.calls), 5)
+        self.assertNotIn('page', TestApi.authorization['params'])
+
+    @responses.activate
+    def test_streaming_pagination(self):
+        def return_val(request):
+            params = dict(parse_qsl(urlparse(request.url).query))
+            page = params.get('page', 1)
+            headers = {'X-Pagination-Page-Count': '2', 'Content-Type': 'application/json'}
+            resp_body = json.dumps(load_test_data('test_pagination_page{}.json'.format(page)), ensure_ascii=False)
+            return 200, headers, resp_body
+
+        responses.add_callback(
+            responses.GET, 'http://example.com/', callback=return_val
+        )
+
+        expected = load_test_data('test_pagination_page1.json') + load_test_data('test_pagination_page2.json')
+        # маленький размер куска, чтобы элементы и многобайтовые символы разрезались между кусками
+        with patch.object(TestApi, 'stream_chunk_size', 5):
+            self.assertEqual(list(TestApi().make_streaming_request('/')), expected)
+
+    def test_json_array_numbers_split_between_chunks(self):
+        data = json.dumps([1.5, -25e10, 123, {'a': 0.75}, True]).encode('utf-8')
+        for size in range(1, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEqual(list(iter_json_array(chunks)), json.loads(data.decode('utf-8')))
+
 
 class TestActivityAPI(TestCase):
     def test_initial_events_load(self):
@@ -180,6 +222,36 @@ class TestActivityAPI(TestCase):
         et = EventType.objects.get(id=et.id)
         self.assertListEqual(et.trace_data, test_json)
 
+    def test_unchanged_events_skipped(self):
+        """
+        проверка того, что активности и эвенты, данные которых не изменились, повторно не обновляются
+        """
+        uid = 'd18093f5-dd5c-41e3-a772-0103402ddf2c'
+        with patch.object(LabsApi, 'get_activities', return_value=iter([load_test_data('api_data.json')])):
+            self.assertTrue(refresh_events_data())
+        self.assertEqual(Event.objects.filter(data_hash='').count(), 0)
+        Event.objects.filter(uid=uid).update(title='test')
+        with patch.object(LabsApi, 'get_activities', return_value=iter([load_test_data('api_data.json')])):
+            self.assertTrue(refresh_events_data())
+        self.assertEqual(Event.objects.get(uid=uid).title, 'test')
+        run = SyncRun.objects.filter(name='refresh_events_data').order_by('-id').first()
+        self.assertEqual(run.status, SyncRun.STATUS_OK)
+        self.assertEqual((run.rows_read, run.skipped, run.inserted, run.updated), (2, 2, 0, 0))
+        with patch.object(LabsApi, 'get_activities', return_value=iter([load_test_data('changed_api_data.json')])):
+            self.assertTrue(refresh_events_data())
+        self.assertEqual(Event.objects.get(uid=uid).title, 'НТИ Global')
+
+    def test_hash_not_saved_after_structure_errors(self):
+        """
+        проверка того, что хэш не сохраняется, если структуру эвента не удалось обновить полностью
+        """
+        with patch.object(LabsApi, 'get_activities', return_value=iter([load_test_data('api_data.json')])), \
+                patch('isle.utils.update_event_structure', return_value=False):
+            self.assertTrue(refresh_events_data())
+        self.assertEqual(Event.objects.count(), 3)
+        self.assertEqual(Event.objects.exclude(data_hash='').count(), 0)
+        self.assertEqual(Activity.objects.filter(event__isnull=False).exclude(data_hash='').count(), 0)
+
     def _get_obj_dict(self, obj, *attrs):
         return {attr: getattr(obj, attr) for attr in attrs}
 
@@ -192,6 +264,30 @@ def mock_pull_sso_user(unti_id):
     )
 
 
+class TestEventAuthors(TestCase):
+    def test_reconcile_keeps_existing_authors(self):
+        now = timezone.now()
+        event = Event.objects.create(uid='event', data={}, title='event', dt_start=now, dt_end=now)
+        users = [User.objects.create_user('user{}'.format(i), unti_id=i) for i in range(1, 5)]
+        user_map = {i.unti_id: i.id for i in users}
+        inactive = EventAuthor.objects.create(event=event, user=users[0], is_active=False,
+                                              source=EventAuthor.SOURCE_ACTIVITY)
+        active = EventAuthor.objects.create(event=event, user=users[1], source=EventAuthor.SOURCE_ACTIVITY)
+        removed = EventAuthor.objects.create(event=event, user=users[2], source=EventAuthor.SOURCE_EVENT)
+        reconcile_event_authors({event.id: {
+            1: EventAuthor.SOURCE_EVENT, 2: EventAuthor.SOURCE_EVENT, 4: EventAuthor.SOURCE_EVENT,
+        }}, user_map, set())
+        # существующие авторы, в том числе неактивные, не изменяются
+        inactive.refresh_from_db()
+        self.assertEqual((inactive.is_active, inactive.source), (False, EventAuthor.SOURCE_ACTIVITY))
+        active.refresh_from_db()
+        self.assertEqual((active.is_active, active.source), (True, EventAuthor.SOURCE_ACTIVITY))
+        removed.refresh_from_db()
+        self.assertFalse(removed.is_active)
+        created = EventAuthor.objects.get(event=event, user=users[3])
+        self.assertEqual((created.is_active, created.source), (True, EventAuthor.SOURCE_EVENT))
+
+
 class TestAttendanceAPI(TestCase):
     def setUp(self):
         a = Activity.objects.create(uid=str(uuid4()), title='title')
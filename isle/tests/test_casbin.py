@@ -0,0 +1,37 @@
+from django.test import SimpleTestCase
+from isle.casbin import UserContextIndex
+
+
+class TestUserContextIndex(SimpleTestCase):
+    MODEL = '[matchers]\nm = g(r.sub, p.sub, r.dom) && r.dom == p.dom && r.obj == p.obj && r.act == p.act'
+
+    def test_candidates(self):
+        index = UserContextIndex('\n'.join([
+            'p, assistant, ctx-1, event, read',
+            'p, 2, ctx-3, event, read',
+            'g, 1, assistant, ctx-1',
+            'g, 1, assistant, ctx-2',
+        ]), self.MODEL)
+        self.assertFalse(index.full_scan)
+        self.assertEqual(index.get_contexts(1), {'ctx-1', 'ctx-2'})
+        self.assertEqual(index.get_contexts(2), {'ctx-3'})
+        self.assertEqual(index.get_contexts(3), set())
+        self.assertEqual(index.get_unti_ids(), {'1', '2'})
+
+    def test_domainless_role(self):
+        index = UserContextIndex('p, assistant, ctx-1, event, read\ng, 1, assistant', self.MODEL)
+        self.assertTrue(index.full_scan)
+        self.assertIsNone(index.get_contexts(1))
+
+    def test_inherited_role(self):
+        index = UserContextIndex('\n'.join([
+            'p, assistant, ctx-1, event, read',
+            'g, 1, senior, ctx-1',
+            'g, senior, assistant, ctx-1',
+        ]), self.MODEL)
+        self.assertTrue(index.full_scan)
+        self.assertIsNone(index.get_contexts(1))
+
+    def test_context_patterns(self):
+        self.assertIsNone(UserContextIndex('g, 1, assistant, *', self.MODEL).get_contexts(1))
+        self.assertIsNone(UserContextIndex('g, 1, assistant, ctx-1', 'keyMatch(r.dom, p.dom)').get_contexts(1))
@@ -1,12 +1,21 @@
+import io
 import os
 import random
 import tarfile
 import time
+import zipfile
+from collections import OrderedDict
+from types import SimpleNamespace
+from unittest.mock import patch
 from django.conf import settings
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from isle.celery import app
 from isle.models import (Event, User, Team, EventMaterial, EventTeamMaterial, EventOnlyMaterial, EventEntry,
-                         LabsTeamResult, LabsUserResult, LabsEventResult)
+                         LabsTeamResult, LabsUserResult, LabsEventResult, CSVDump, Activity, Run, RunEnrollment)
+from isle.tasks import generate_events_csv
+from isle.utils import EventMaterialsCSV
 from isle.views import EventCsvData
 
 
@@ -137,3 +146,202 @@ class TestGenerationTime(TestCase):
 
     def test_100_users(self):
         self.generate_and_check_time(100, self.filled)
+
+
+class TestShardedGeneration(TestCase):
+    """
+    выгрузка, собранная из частей, должна совпадать с выгрузкой, сгенерированной одной задачей
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('assistant', 'assistant@example.com', 'password', is_assistant=True)
+        now = timezone.now()
+        self.event_ids = []
+        for i in range(5):
+            event = Event.objects.create(uid='event_{}'.format(i), data={}, title='event {}'.format(i),
+                                         dt_start=now, dt_end=now)
+            self.event_ids.append(event.id)
+            for j in range(i + 1):
+                EventOnlyMaterial.objects.create(event=event, url='http://example.com/{}_{}.csv'.format(i, j),
+                                                 comment='comment {}'.format(j), initiator=j)
+        self.meta = {'activity': None, 'context': None, 'date_min': None, 'date_max': None}
+        self.dumps = []
+
+    def tearDown(self):
+        for dump in self.dumps:
+            if dump.csv_file:
+                dump.csv_file.delete(save=False)
+
+    def generate(self, file_format, shard_size):
+        dump = CSVDump.objects.create(owner=self.user, header='test', meta_data=self.meta)
+        with override_settings(CSV_EXPORT_SHARD_SIZE=shard_size), patch.object(app.conf, 'task_always_eager', True):
+            # порядок id не должен влиять на порядок строк
+            generate_events_csv(dump.id, list(reversed(self.event_ids)), file_format, dict(self.meta))
+        dump.refresh_from_db()
+        self.dumps.append(dump)
+        self.assertEqual(dump.status, CSVDump.STATUS_COMPLETE)
+        with dump.csv_file.open('rb') as f:
+            return dump, f.read()
+
+    def test_csv(self):
+        __, expected = self.generate('csv', 0)
+        dump, content = self.generate('csv', 2)
+        self.assertEqual((dump.shards_total, dump.shards_done), (3, 3))
+        self.assertEqual(content, expected)
+        self.assertEqual(len(content.decode('utf-8').splitlines()), 1 + 15)
+
+    def test_xlsx(self):
+        __, expected = self.generate('xls', 0)
+        dump, content = self.generate('xls', 2)
+        self.assertEqual((dump.shards_total, dump.shards_done), (3, 3))
+        sheets = []
+        for data in (expected, content):
+            with zipfile.ZipFile(io.BytesIO(data)) as z:
+                sheets.append(z.read('xl/worksheets/sheet1.xml'))
+        self.assertEqual(sheets[1], sheets[0])
+
+
+@override_settings(CSV_EXPORT_CACHE_TTL=60)
+class TestExportCache(TestCase):
+    """
+    переиспользование готовых выгрузок
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('assistant', 'assistant@example.com', 'password', is_assistant=True)
+        activity = Activity.objects.create(uid='activity', title='activity')
+        self.run = Run.objects.create(uuid='run', activity=activity)
+        now = timezone.now()
+        self.event = Event.objects.create(uid='event', data={}, title='event', dt_start=now, dt_end=now,
+                                          activity=activity, run=self.run)
+        self.team = Team.objects.create(event=self.event, name='team', creator=self.user)
+        self.event_ids = [self.event.id]
+        self.cache_key = CSVDump.get_cache_key({}, self.event_ids)
+
+    def make_dump(self, **kwargs):
+        kwargs.setdefault('datetime_ready', timezone.now())
+        return CSVDump.objects.create(owner=self.user, header='test', cache_key=self.cache_key,
+                                      csv_file='csv-dumps/test.csv', status=CSVDump.STATUS_COMPLETE, **kwargs)
+
+    def assertInvalidated(self, action):
+        self.make_dump(datetime_ordered=timezone.now())
+        self.assertIsNotNone(CSVDump.get_cached(self.cache_key, self.event_ids))
+        action()
+        self.assertIsNone(CSVDump.get_cached(self.cache_key, self.event_ids))
+
+    def test_ttl_counts_from_generation(self):
+        # копия, переиспользовавшая старую выгрузку, не продлевает ее срок
+        old = timezone.now() - timezone.timedelta(seconds=120)
+        self.make_dump(datetime_ordered=timezone.now(), datetime_ready=old)
+        self.assertIsNone(CSVDump.get_cached(self.cache_key, self.event_ids))
+
+    def test_event_entry(self):
+        self.assertInvalidated(lambda: EventEntry.objects.create(event=self.event, user=self.user))
+
+    def test_run_enrollment(self):
+        self.assertInvalidated(lambda: RunEnrollment.objects.create(run=self.run, user=self.user))
+
+    def test_reverse_clear(self):
+        self.team.users.add(self.user)
+        self.assertInvalidated(lambda: self.user.team_set.clear())
+
+
+class TestRowTemplate(TestCase):
+    """
+    сравнение построения строк выгрузки по скомпилированному шаблону с построением через OrderedDict
+    на выгрузке в 100 000 строк
+    """
+    MATERIALS_NUM = 10000
+    META_NUM = 10
+    REPEATS = 3
+    MAX_TIME_RATIO = 0.8
+
+    def setUp(self):
+        now = timezone.now()
+        self.obj = EventMaterialsCSV(Event(uid='event', title='event', dt_start=now, dt_end=now))
+        meta = [{'sector': 1, 'level': i, 'sublevel': i, 'tools': ['tool'], 'model': None, 'competence': None}
+                for i in range(self.META_NUM)]
+        block = SimpleNamespace(title='block', block_type='type', description='description')
+        result_v2 = SimpleNamespace(
+            result=SimpleNamespace(title='result', block=block, meta=meta),
+            approved=True,
+            comment='comment',
+            get_meta=lambda: meta,
+        )
+        self.materials = [SimpleNamespace(
+            initiator=i,
+            get_url=lambda: 'http://example.com/some_file.csv',
+            get_extension=lambda: 'csv',
+            summary_id=None,
+            result_v2=result_v2,
+            user=SimpleNamespace(unti_id=i, leader_id=i, last_name='last', first_name='first', second_name='second'),
+        ) for i in range(self.MATERIALS_NUM)]
+
+    def dict_lines(self, m):
+        """
+        построение строк так, как это делалось до появления RowTemplate
+        """
+        obj = self.obj
+        d = OrderedDict([(k, '') for k in obj.field_names()])
+        d.update({'title': obj.event.title, 'dt_start': obj.dt_start, 'dt_end': obj.dt_end})
+        d.update({
+            'initiator': m.initiator or '',
+            'file_url': m.get_url(),
+            'file_extension': m.get_extension(),
+            'comment': obj.get_comment(m, obj.TYPE_PERSONAL),
+            'type': obj.get_type(obj.TYPE_PERSONAL),
+            'summary_content': '',
+        })
+        d.update({
+            'unti_id': m.user.unti_id or '',
+            'leader_id': m.user.leader_id or '',
+            'last_name': m.user.last_name,
+            'first_name': m.user.first_name,
+            'second_name': m.user.second_name,
+        })
+        d.update({
+            'block_title': m.result_v2.result.block.title,
+            'result_title': m.result_v2.result.title,
+            'meta_type': m.result_v2.result.block.block_type,
+            'meta_activity': m.result_v2.result.block.description,
+            'approved': str(m.result_v2.approved),
+        })
+        meta = obj.get_meta(m)
+        d['lines_num'] = len(meta)
+        for item in meta:
+            line = d.copy()
+            line.update({
+                'sector': item.get('sector', ''),
+                'level': item.get('level', ''),
+                'sublevel': item.get('sublevel', ''),
+                'meta_instruments': obj.format_tools(item.get('tools')),
+                'meta_model': obj.model_names.get(item.get('model'), ''),
+                'meta_sector_name': obj.competence_names.get(item.get('competence'), ''),
+            })
+            yield line.values()
+
+    def test_row_template(self):
+        self.assertEqual(list(self.obj.generate_headers()), [str(i) for i in self.obj.field_names().values()])
+        self.assertEqual(
+            [list(i) for i in self.dict_lines(self.materials[0])],
+            list(self.obj.lines_for_personal_material(self.materials[0])),
+        )
+
+        # лучшее из нескольких повторений, чтобы случайные задержки на загруженной машине не влияли на результат
+        dict_time = template_time = float('inf')
+        for __ in range(self.REPEATS):
+            t = time.perf_counter()
+            rows_num = sum(1 for m in self.materials for __ in self.dict_lines(m))
+            dict_time = min(dict_time, time.perf_counter() - t)
+
+            t = time.perf_counter()
+            template_rows_num = sum(1 for m in self.materials for __ in self.obj.lines_for_personal_material(m))
+            template_time = min(template_time, time.perf_counter() - t)
+            self.assertEqual(rows_num, template_rows_num)
+
+        self.assertEqual(rows_num, self.MATERIALS_NUM * self.META_NUM)
+        print('rows {}, OrderedDict {}s ({}us/row), RowTemplate {}s ({}us/row)'.format(
+            rows_num,
+            round(dict_time, 3), round(dict_time / rows_num * 10 ** 6, 2),
+            round(template_time, 3), round(template_time / rows_num * 10 ** 6, 2),
+        ))
+        # запас на погрешность измерений: шаблон должен быть быстрее хотя бы на 20%
+        self.assertLess(template_time, dict_time * self.MAX_TIME_RATIO)
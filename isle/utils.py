@@ -1,17 +1,24 @@
 import csv
+import hashlib
 import json
 import io
 import logging
 import os
 import pytz
+import time
+import traceback
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import RLock
 from io import StringIO
+from types import SimpleNamespace
 from urllib.parse import quote
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.conf import settings
 from django.core.cache import caches
 from django.core.files.storage import default_storage
-from django.db import models, transaction
+from django.db import connection, models, transaction, IntegrityError
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.utils.functional import cached_property
@@ -21,6 +28,9 @@ from celery.task.control import inspect
 from rest_framework.authtoken.models import Token
 from isle.api import ApiError, LabsApi, XLEApi, DpApi, SSOApi, PTApi, Openapi
 from isle.cache import UserContextAssistantCache
+from isle.bulk import bulk_upsert, bulk_set_related, chunks, iter_batches, get_chunk_size
+from isle.casbin import enforcer_registry
+from isle import journal
 from isle.models import (Event, EventEntry, User, Trace, EventType, Activity, EventOnlyMaterial, ApiUserChart, Context,
                          LabsEventBlock, LabsEventResult, LabsUserResult, EventMaterial, MetaModel, EventTeamMaterial,
                          Team, Author, DpCompetence, CasbinData, Run, RunEnrollment, DTraceStatistics, DPType, EventAuthor,
@@ -28,6 +38,7 @@ from isle.models import (Event, EventEntry, User, Trace, EventType, Activity, Ev
 
 DEFAULT_CACHE = caches['default']
 EVENT_TYPES_CACHE_KEY = 'EVENT_TYPE_IDS'
+SSO_PULL_FAILED_KEY = 'sso-pull-failed:{}'
 
 
 def get_allowed_event_type_ids():
@@ -40,11 +51,32 @@ def get_authors_unti_ids(authors):
     return set()
 
 
+def get_data_hash(data):
+    """
+    хэш json-структуры, не зависящий от порядка ключей
+    """
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def get_activity_events_uids(activity):
+    uids = set()
+    for run in activity.get('runs') or []:
+        if run.get('uuid'):
+            uids.update(event['uuid'] for event in run.get('events') or [])
+    return uids
+
+
+@journal.sync_journal('refresh_events_data')
 def refresh_events_data(fast=True):
     """
     Обновление списка эвентов и активностей. Предполагается, что этот список меняется редко (или не меняется вообще).
     В процессе обновления эвент может быть удален, но только если он запланирован как минимум на следующий день.
     Если fast==True, обновляется список событий за вчера, сегодня и завтра.
+    Активности и эвенты, хэш данных которых совпадает с сохраненным, не обновляются. Хэш сохраняется,
+    только если все авторы активности или эвента есть в uploads, иначе они будут обработаны в следующий раз.
+    При LABS_STREAM_ACTIVITIES активности разбираются из ответа labs по одной, так что в памяти находится
+    только текущая активность. Пачки по LABS_STREAM_BATCH_SIZE ленивые и определяют только, после скольких
+    активностей сохраняются собранные по ним авторы и хэши
     """
     def _parse_dt(val):
         try:
@@ -54,7 +86,10 @@ def refresh_events_data(fast=True):
 
     try:
         event_types = {}
-        existing_uids = set(Event.objects.values_list('uid', flat=True))
+        event_hashes = dict(Event.objects.values_list('uid', 'data_hash'))
+        activity_hashes = dict(Activity.objects.values_list('uid', 'data_hash'))
+        existing_uids = set(event_hashes)
+        stats = defaultdict(int)
         unti_id_to_user_id = dict(User.objects.filter(unti_id__isnull=False).values_list('unti_id', 'id'))
         failed_users = set()
         competences = {}
@@ -70,8 +105,23 @@ def refresh_events_data(fast=True):
             today = timezone.datetime.now().date()
             date_min = (today - timezone.timedelta(days=1)).strftime('%Y-%m-%d')
             date_max = (today + timezone.timedelta(days=1)).strftime('%Y-%m-%d')
-        for data in LabsApi().get_activities(date_min=date_min, date_max=date_max):
+        stream = getattr(settings, 'LABS_STREAM_ACTIVITIES', False)
+        pages = LabsApi().get_activities(date_min=date_min, date_max=date_max, stream=stream)
+        if stream:
+            pages = iter_batches(pages, getattr(settings, 'LABS_STREAM_BATCH_SIZE', 100))
+        for data in pages:
+            # авторы и хэши сохраняются одним пакетом после обработки всей страницы, отсутствующие
+            # в uploads авторы запрашиваются из sso там же
+            activities_authors, events_authors = {}, {}
+            activity_hashes_to_save, event_hashes_to_save = {}, {}
             for activity in data:
+                journal.add(rows_read=1)
+                activity_hash = get_data_hash(activity)
+                if activity.get('uuid') and activity_hashes.get(activity['uuid']) == activity_hash:
+                    stats['activities_skipped'] += 1
+                    journal.add(skipped=1)
+                    fetched_events.update(get_activity_events_uids(activity))
+                    continue
                 for ctx in activity['contexts']:
                     if ctx.get('uuid') in contexts:
                         continue
@@ -111,8 +161,10 @@ def refresh_events_data(fast=True):
                             'is_deleted': bool(activity.get('is_deleted')),
                         }
                     )[0]
-                    update_authors(current_activity, authors)
+                    activities_authors[current_activity.id] = authors
                     activity_authors = get_authors_unti_ids(authors)
+                    activity_unti_ids = set(activity_authors)
+                    activity_complete = True
                 else:
                     continue
                 if activity_type and activity_type.get('uuid'):
@@ -142,9 +194,15 @@ def refresh_events_data(fast=True):
                     )[0]
                     events = run.get('events') or []
                     for event in events:
+                        uid = event['uuid']
+                        fetched_events.add(uid)
+                        event_hash = get_data_hash({'event': event, 'run': run_json, 'activity': activity_json})
+                        if event_hashes.get(uid) == event_hash:
+                            stats['events_skipped'] += 1
+                            journal.add(skipped=1)
+                            continue
                         event_authors = get_authors_unti_ids(event.get('authors'))
                         event_json = filter_dict(event, EVENT_EXCLUDE_KEYS)
-                        uid = event['uuid']
                         timeslot = event.get('timeslot')
                         is_active = not (event.get('is_deleted') or current_run.deleted or
                                          current_activity.is_deleted)
@@ -160,19 +218,41 @@ def refresh_events_data(fast=True):
                             'run': current_run,
                             'context_id': event_context_id,
                             'data': {'event': event_json, 'run': run_json, 'activity': activity_json},
-                            'dt_start': dt_start, 'dt_end': dt_end, 'title': title, 'event_type': event_type})
-                        assign_event_authors(e, activity_authors, event_authors, unti_id_to_user_id, failed_users)
-                        update_event_structure(
+                            'dt_start': dt_start, 'dt_end': dt_end, 'title': title, 'event_type': event_type,
+                            'materials_modified_at': timezone.now()})
+                        events_authors[e.id] = get_event_authors_sources(activity_authors, event_authors)
+                        structure_updated = update_event_structure(
                             event.get('blocks', []),
                             e,
                             e.blocks.values_list('uuid', flat=True) if not e_created else [],
                             metamodels,
                             competences,
                         )
-                        fetched_events.add(e.uid)
+                        stats['events_written'] += 1
+                        journal.add(inserted=int(e_created), updated=int(not e_created))
+                        activity_unti_ids |= event_authors
+                        if not structure_updated:
+                            # хэш не сохраняется, чтобы мероприятие обновилось при следующем запуске
+                            activity_complete = False
+                            continue
+                        event_hashes_to_save[e.id] = (event_hash, activity_authors | event_authors)
+                stats['activities_written'] += 1
+                if activity_complete:
+                    activity_hashes_to_save[current_activity.id] = (activity_hash, activity_unti_ids)
+            update_activities_authors(activities_authors)
+            reconcile_event_authors(events_authors, unti_id_to_user_id, failed_users)
+            for model, hashes in ((Event, event_hashes_to_save), (Activity, activity_hashes_to_save)):
+                for obj_id, (data_hash, unti_ids) in hashes.items():
+                    if all(i in unti_id_to_user_id for i in unti_ids):
+                        model.objects.filter(id=obj_id).update(data_hash=data_hash)
+        logging.info('Events data refreshed: activities written %s, skipped %s; events written %s, skipped %s',
+                     stats['activities_written'], stats['activities_skipped'],
+                     stats['events_written'], stats['events_skipped'])
         if not fast:
             delete_events = existing_uids - fetched_events - {getattr(settings, 'API_DATA_EVENT', '')}
-            Event.objects.filter(uid__in=delete_events).update(is_active=False)
+            # сброс хэшей, чтобы эвенты снова обновились, если вернутся в labs
+            Activity.objects.filter(event__uid__in=delete_events).update(data_hash='')
+            Event.objects.filter(uid__in=delete_events).update(is_active=False, data_hash='')
             # если произошли изменения в списке будущих эвентов
             dt = timezone.now() + timezone.timedelta(days=1)
             delete_qs = Event.objects.filter(uid__in=delete_events, dt_start__gt=dt)
@@ -182,49 +262,78 @@ def refresh_events_data(fast=True):
                 delete_qs.delete()
         return True
     except ApiError:
+        journal.fail('Labs api error')
         return
     except Exception:
         logging.exception('Failed to handle events data')
+        journal.fail(traceback.format_exc())
 
 
-def assign_event_authors(event, activity_authors, event_authors, user_map, failed_users):
-    all_authors = activity_authors | event_authors
-    current_authors = set(EventAuthor.objects.filter(event=event).values_list('user_id', flat=True))
-    real_authors = set()
-    for unti_id in all_authors:
-        user_id = user_map.get(unti_id)
-        if not user_id and unti_id in failed_users:
-            continue
-        if not user_id:
-            user = pull_sso_user(unti_id)
-            if not user:
-                failed_users.add(unti_id)
-                continue
-            user_id = user.id
-            user_map[unti_id] = user_id
-        real_authors.add(user_id)
-        if user_id in current_authors:
-            continue
-        else:
-            EventAuthor.objects.update_or_create(event=event, user_id=user_id, defaults={
-                'is_active': True,
-                'source': EventAuthor.SOURCE_EVENT if unti_id in event_authors else EventAuthor.SOURCE_ACTIVITY,
-            })
-    if current_authors - real_authors:
-        EventAuthor.objects.filter(event=event).exclude(user_id__in=real_authors).update(is_active=False)
+def get_event_authors_sources(activity_authors, event_authors):
+    """
+    словарь unti_id автора эвента -> источник, из которого он пришел
+    """
+    sources = dict.fromkeys(activity_authors, EventAuthor.SOURCE_ACTIVITY)
+    sources.update(dict.fromkeys(event_authors, EventAuthor.SOURCE_EVENT))
+    return sources
 
 
-def update_authors(activity, data):
-    authors = []
-    for item in data:
-        uid = item.get('uuid')
-        if not uid:
-            continue
-        authors.append(Author.objects.update_or_create(uuid=uid, defaults={
-            'title': item.get('title') or '',
-            'is_main': item.get('is_main'),
-        })[0])
-    activity.authors.set(authors)
+def reconcile_event_authors(events_authors, user_map, failed_users, chunk_size=None):
+    """
+    массовое обновление авторов эвентов. events_authors - словарь id эвента -> словарь unti_id автора ->
+    источник (EventAuthor.SOURCE_EVENT или EventAuthor.SOURCE_ACTIVITY). Недостающие пользователи
+    запрашиваются из sso, текущие авторы пачки эвентов загружаются одним запросом, новые создаются через
+    bulk_create, существующие (в том числе неактивные) не изменяются, а те, которых больше нет в данных,
+    деактивируются
+    """
+    chunk_size = get_chunk_size(chunk_size)
+    pull_sso_users(set().union(*events_authors.values()), user_map, failed_users)
+    created, deactivated = 0, 0
+    for event_ids in chunks(events_authors, chunk_size):
+        required = {}
+        for event_id in event_ids:
+            for unti_id, source in events_authors[event_id].items():
+                user_id = user_map.get(unti_id)
+                if user_id:
+                    required[(event_id, user_id)] = source
+        with transaction.atomic():
+            current = {}
+            qs = EventAuthor.objects.filter(event_id__in=event_ids)
+            for item in qs.values('id', 'event_id', 'user_id', 'is_active'):
+                current[(item['event_id'], item['user_id'])] = item
+            to_deactivate = [item['id'] for key, item in current.items() if key not in required and item['is_active']]
+            if to_deactivate:
+                deactivated += EventAuthor.objects.filter(id__in=to_deactivate).update(is_active=False)
+            objs = [EventAuthor(event_id=event_id, user_id=user_id, source=source, is_active=True)
+                    for (event_id, user_id), source in required.items() if (event_id, user_id) not in current]
+            try:
+                with transaction.atomic():
+                    EventAuthor.objects.bulk_create(objs)
+            except IntegrityError:
+                # автор мог быть добавлен параллельно, сохраняем построчно
+                for obj in objs:
+                    EventAuthor.objects.update_or_create(event_id=obj.event_id, user_id=obj.user_id, defaults={
+                        'is_active': True, 'source': obj.source,
+                    })
+            created += len(objs)
+    journal.add(inserted=created, updated=deactivated)
+    logging.info('Event authors: created %s, deactivated %s', created, deactivated)
+
+
+def update_activities_authors(activities_authors):
+    """
+    обновление авторов активностей. activities_authors - словарь id активности -> список авторов из labs
+    """
+    rows = {}
+    for authors in activities_authors.values():
+        for item in authors:
+            if item.get('uuid'):
+                rows[item['uuid']] = {'title': item.get('title') or '', 'is_main': item.get('is_main')}
+    author_ids = bulk_upsert(Author, 'uuid', rows).ids
+    bulk_set_related(Activity.authors.through, ('activity_id', 'author_id'), {
+        activity_id: [author_ids[item['uuid']] for item in authors if item.get('uuid')]
+        for activity_id, authors in activities_authors.items()
+    })
 
 
 def update_event_structure(data, event, event_blocks_uuid, metamodels, competences):
@@ -233,6 +342,7 @@ def update_event_structure(data, event, event_blocks_uuid, metamodels, competenc
     :param data json со структурой
     :param event объект Event
     :param event_blocks_uuid список текущих uuid-ов блоков мероприятия
+    :return: True, если структура обновлена полностью, False, если при обновлении были ошибки
     """
     def _parse_meta(meta):
         if isinstance(meta, str):
@@ -245,6 +355,8 @@ def update_event_structure(data, event, event_blocks_uuid, metamodels, competenc
         return
 
     created_blocks = []
+    results_meta = {}
+    success = True
     try:
         for block_order, block in enumerate(data, 1):
             block_uuid = block.get('uuid')
@@ -285,44 +397,36 @@ def update_event_structure(data, event, event_blocks_uuid, metamodels, competenc
                         # еще не подтягивалась в рамках данного запуска обновления данных активностей и эвентов
                         if isinstance(model, dict) and model.get('model') and model['model'] not in metamodels:
                             try:
-                                meta_data = DpApi().get_metamodel(model['model'])
-                                metamodel = parse_model(meta_data)
-                                competences.update(dict(metamodel.competences.values_list('competence__uuid', 'competence_id')))
+                                metamodel = fetch_metamodel(model['model'])
                                 if metamodel:
                                     metamodels[model['model']] = metamodel.id
+                                    competences.update(dict(
+                                        metamodel.competences.values_list('competence__uuid', 'competence_id')))
                             except ApiError:
-                                pass
-                    create_circle_items_for_result(
-                        r.id,
-                        [] if r_created else list(r.circle_items.filter(created_in=CircleItem.SYSTEM_LABS).
-                                                  values_list('id', flat=True)),
-                        meta,
-                        metamodels,
-                        competences
-                    )
+                                success = False
+                    results_meta[r.id] = meta
                 created_results.append(r.uuid)
             if set(block_results) - set(created_results):
                 b.results.exclude(uuid__in=created_results).update(deleted=True)
+        reconcile_circle_items(results_meta, metamodels, competences)
         if set(event_blocks_uuid) - set(created_blocks):
             event.blocks.exclude(uuid__in=created_blocks).update(deleted=True)
     except Exception:
         logging.exception('Failed to parse event structure')
+        return False
+    return success
 
 
-def create_circle_items_for_result(result_id, current_circle_items_ids, meta, metamodels, competences):
+def get_circle_items_data(result_id, meta, metamodels, competences):
     """
-    апдейт элементов колеса, доступных для разметки результата по данным labs. В current_circle_items_ids
-    должны быть переданы id элементов, которые были созданы в labs, чтобы те, что были созданы в uploads,
-    не были удалены
+    данные элементов колеса для результата по его метаданным из labs
     """
-    from isle.kafka import send_object_info, KafkaActions
-    real_items_ids = []
     for meta_item in meta:
         tools = meta_item.get('tools')
         if not isinstance(tools, list):
             tools = [None]
         for tool in tools:
-            circle_data = dict(
+            yield dict(
                 level=meta_item.get('level'),
                 sublevel=meta_item.get('sublevel'),
                 competence_uuid=meta_item.get('competence'),
@@ -330,30 +434,77 @@ def create_circle_items_for_result(result_id, current_circle_items_ids, meta, me
                 result_id=result_id,
                 tool=tool,
                 competence_id=competences.get(meta_item.get('competence')),
-                model_id = metamodels.get(meta_item.get('model')),
+                model_id=metamodels.get(meta_item.get('model')),
                 source=CircleItem.SYSTEM_LABS,
             )
-            code = CircleItem(**circle_data).get_code()
-            circle_item, created = CircleItem.objects.update_or_create(
-                code=code, defaults=circle_data
-            )
-            if created:
-                CircleItem.objects.filter(id=circle_item.id).update(created_in=CircleItem.SYSTEM_LABS)
-            real_items_ids.append(circle_item.id)
-    deleted_circle_items = set(current_circle_items_ids) - set(real_items_ids)
-    if deleted_circle_items:
-        # удалили какой-то элемент круга из разметки мероприятия, надо обновить связанные с ним
-        # пользовательские и командные результаты
-        results_to_update = []
-        for result_model in (LabsUserResult, LabsTeamResult):
-            results_to_update.extend(
-                list(result_model.objects.filter(circle_items__id__in=deleted_circle_items)
-                     .distinct())
-            )
-        CircleItem.objects.filter(id__in=deleted_circle_items).delete()
-        for _result in results_to_update:
-            send_object_info(_result, _result.id, KafkaActions.UPDATE)
-    return real_items_ids
+
+
+def reconcile_circle_items(results_meta, metamodels, competences, chunk_size=None):
+    """
+    апдейт элементов колеса, доступных для разметки результатов по данным labs. results_meta - словарь
+    id результата -> метаданные результата. Для пачки результатов коды всех элементов считаются сразу,
+    существующие элементы загружаются одним запросом, недостающие создаются через bulk_create, а элементы,
+    созданные в labs и пропавшие из разметки, удаляются. Элементы, созданные в uploads, не удаляются.
+    Сообщения в кафку об изменении связанных результатов отправляются по одному на результат после
+    обработки всех пачек. Возвращает словарь id результата -> список id его элементов колеса
+    """
+    from isle.kafka import send_object_info, KafkaActions
+    chunk_size = get_chunk_size(chunk_size)
+    result_items = defaultdict(list)
+    results_to_update = {}
+    for result_ids in chunks(results_meta, chunk_size):
+        items = OrderedDict()
+        for result_id in result_ids:
+            for circle_data in get_circle_items_data(result_id, results_meta[result_id], metamodels, competences):
+                items.setdefault(CircleItem(**circle_data).get_code(), circle_data)
+        with transaction.atomic():
+            existing = {}
+            for codes in chunks(items, chunk_size):
+                qs = CircleItem.objects.filter(code__in=codes)
+                for item in qs.values('id', 'code', 'competence_id', 'model_id', 'source'):
+                    existing[item.pop('code')] = item
+            changed, to_create = defaultdict(list), []
+            for code, circle_data in items.items():
+                item = existing.get(code)
+                if item is None:
+                    to_create.append(CircleItem(code=code, created_in=CircleItem.SYSTEM_LABS, **circle_data))
+                    continue
+                values = (circle_data['competence_id'], circle_data['model_id'], circle_data['source'])
+                if values != (item['competence_id'], item['model_id'], item['source']):
+                    changed[values].append(item['id'])
+            for (competence_id, model_id, source), ids in changed.items():
+                CircleItem.objects.filter(id__in=ids).update(competence_id=competence_id, model_id=model_id,
+                                                             source=source)
+            journal.add(inserted=len(to_create), updated=sum(map(len, changed.values())),
+                        skipped=len(existing) - sum(map(len, changed.values())))
+            code_to_id = {code: item['id'] for code, item in existing.items()}
+            for objs in chunks(to_create, chunk_size):
+                CircleItem.objects.bulk_create(objs)
+                code_to_id.update(CircleItem.objects.filter(code__in=[obj.code for obj in objs])
+                                  .values_list('code', 'id'))
+            for code, circle_data in items.items():
+                result_items[circle_data['result_id']].append(code_to_id[code])
+
+            real_items_ids = set(code_to_id.values())
+            deleted_circle_items = set(
+                CircleItem.objects.filter(result_id__in=result_ids, created_in=CircleItem.SYSTEM_LABS)
+                .values_list('id', flat=True)
+            ) - real_items_ids
+            if deleted_circle_items:
+                # удалили какой-то элемент круга из разметки мероприятия, надо обновить связанные с ним
+                # пользовательские и командные результаты
+                for result_model in (LabsUserResult, LabsTeamResult):
+                    for _result in result_model.objects.filter(circle_items__id__in=deleted_circle_items).distinct():
+                        results_to_update[(result_model, _result.id)] = _result
+                CircleItem.objects.filter(id__in=deleted_circle_items).delete()
+                journal.add(deleted=len(deleted_circle_items))
+            if to_create or changed or deleted_circle_items:
+                Event.touch_materials(
+                    LabsEventResult.objects.filter(id__in=result_ids).values_list('block__event_id', flat=True)
+                )
+    for _result in results_to_update.values():
+        send_object_info(_result, _result.id, KafkaActions.UPDATE)
+    return result_items
 
 
 def parse_competences(data, metamodel, competences):
@@ -376,6 +527,7 @@ def parse_competences(data, metamodel, competences):
     ModelCompetence.objects.filter(model=metamodel).exclude(id__in=comps).delete()
 
 
+@journal.sync_journal('update_event_entries')
 def update_event_entries():
     """
     добавление EventEntry по данным из xle
@@ -393,6 +545,10 @@ def update_event_entries():
             for item in data:
                 if (item.get('attendance') or item.get('checkin')) and item.get('event_uuid') and item.get('unti_id'):
                     by_event[item['event_uuid']].append(item['unti_id'])
+        all_unti_ids = {unti_id for unti_ids in by_event.values() for unti_id in unti_ids}
+        for unti_id in pull_sso_users(all_unti_ids, unti_id_to_id, failed_unti_ids):
+            logging.error('User with unti_id %s not found' % unti_id)
+        journal.add(rows_read=sum(len(unti_ids) for unti_ids in by_event.values()))
         for event_uuid, unti_ids in by_event.items():
             event_id = events.get(event_uuid)
             if not event_id:
@@ -401,28 +557,24 @@ def update_event_entries():
             users = []
             for unti_id in unti_ids:
                 user_id = unti_id_to_id.get(unti_id)
-                if not user_id:
-                    if unti_id in failed_unti_ids:
-                        continue
-                    created_user = pull_sso_user(unti_id)
-                    if not created_user:
-                        logging.error('User with unti_id %s not found' % unti_id)
-                        failed_unti_ids.add(unti_id)
-                        continue
-                    user_id = created_user.id
-                    unti_id_to_id[unti_id] = user_id
-                users.append(user_id)
+                if user_id:
+                    users.append(user_id)
             existing = list(EventEntry.objects.filter(event__uid=event_uuid).values_list('user_id', flat=True))
             create = set(users) - set(existing)
+            journal.add(skipped=len(set(users)) - len(create))
             for user_id in create:
-                EventEntry.all_objects.update_or_create(event_id=event_id, user_id=user_id, defaults={'deleted': False})
+                __, created = EventEntry.all_objects.update_or_create(
+                    event_id=event_id, user_id=user_id, defaults={'deleted': False})
+                journal.add(inserted=int(created), updated=int(not created))
         # обновление времени последнего обновления чекинов, если все прошло удачно
         UpdateTimes.set_last_update_for_event(UpdateTimes.CHECKINS, update_time)
         return True
     except ApiError:
+        journal.fail('XLE api error')
         return False
     except Exception:
         logging.exception('Failed to parse xle attendance')
+        journal.fail(traceback.format_exc())
 
 
 def update_run_enrollments():
@@ -433,22 +585,17 @@ def update_run_enrollments():
     updated_at = UpdateTimes.get_last_update_for_event(UpdateTimes.RUN_ENROLLMENTS)
     try:
         for data in XLEApi().get_timetable(updated_at=updated_at):
+            page_unti_ids = {int(item['unti_id']) for item in data if item['run_uuid'] in run_uuid_to_id}
+            for unti_id in pull_sso_users(page_unti_ids, unti_id_to_id, failed_unti_ids):
+                logging.error('user with unti_id %s not found' % unti_id)
             for item in data:
                 run_id = run_uuid_to_id.get(item['run_uuid'])
                 if not run_id:
                     logging.error('run with uuid %s not found' % item['run_uuid'])
                     continue
-                if item['unti_id'] in failed_unti_ids:
-                    continue
                 user_id = unti_id_to_id.get(int(item['unti_id']))
                 if not user_id:
-                    user = pull_sso_user(item['unti_id'])
-                    if not user:
-                        logging.error('user with unti_id %s not found' % item['unti_id'])
-                        failed_unti_ids.add(item['unti_id'])
-                        continue
-                    user_id = user.id
-                    unti_id_to_id[int(item['unti_id'])] = user_id
+                    continue
                 RunEnrollment.all_objects.update_or_create(
                     user_id=user_id, run_id=run_id, defaults={'deleted': False}
                 )
@@ -483,7 +630,10 @@ def clear_run_enrollments():
                 run_enrollment_id = created_enrollments.get((user_id, run_id))
                 if run_enrollment_id:
                     ids.add(run_enrollment_id)
-        res = qs.exclude(id__in=ids).update(deleted=True)
+        to_delete = qs.exclude(id__in=ids)
+        run_ids = set(to_delete.values_list('run_id', flat=True))
+        res = to_delete.update(deleted=True)
+        Event.touch_runs_materials(run_ids)
         logging.info('%s RunEnrollment entries marked as deleted', res)
     except ApiError:
         pass
@@ -505,6 +655,98 @@ def pull_sso_user(unti_id):
     return User.objects.filter(unti_id=unti_id).first()
 
 
+def _pull_sso_user_with_retries(unti_id, close_connection=False):
+    retries = getattr(settings, 'SSO_PULL_RETRIES', 1)
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(attempt * getattr(settings, 'SSO_PULL_RETRY_DELAY', 0.5))
+            user = pull_sso_user(unti_id)
+            if user:
+                return unti_id, user.id
+        return unti_id, None
+    finally:
+        if close_connection:
+            # соединение с базой, открытое в потоке пула, больше не понадобится
+            connection.close()
+
+
+class SSOPullExecutor:
+    """
+    Общий для всех потоков процесса пул из SSO_PULL_WORKERS потоков для пропушивания пользователей из sso.
+    Шаги синхронизации, выполняемые одновременно, используют один пул, поэтому соединений с базой у потоков
+    пропушивания не больше SSO_PULL_WORKERS на процесс. Если пользователь уже запрашивается, повторный запрос
+    не отправляется, а возвращается тот же future. Пул создается заново в дочернем процессе после fork
+    """
+    def __init__(self):
+        # RLock, так как callback уже завершенного future вызывается сразу в add_done_callback
+        self._lock = RLock()
+        self._executor = None
+        self._pid = None
+        self._pending = {}
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SSO_PULL_WORKERS', 8))
+            self._pid = os.getpid()
+            self._pending = {}
+        return self._executor
+
+    def submit(self, unti_id):
+        with self._lock:
+            future = self._pending.get(unti_id)
+            if future is None:
+                future = self._get_executor().submit(
+                    journal.wrap(_pull_sso_user_with_retries), unti_id, close_connection=True
+                )
+                self._pending[unti_id] = future
+                future.add_done_callback(partial(self._done, unti_id))
+            return future
+
+    def _done(self, unti_id, future):
+        with self._lock:
+            if self._pending.get(unti_id) is future:
+                del self._pending[unti_id]
+
+
+sso_pull_executor = SSOPullExecutor()
+
+
+def pull_sso_users(unti_ids, user_map, failed_users):
+    """
+    пропушивание из sso сразу нескольких пользователей, которых нет в user_map (unti_id -> user id).
+    Запросы выполняются параллельно в общем пуле sso_pull_executor, каждый повторяется до SSO_PULL_RETRIES
+    раз. Полученные пользователи добавляются в user_map, неполученные - в failed_users и в кэш на
+    SSO_PULL_FAILED_TTL секунд, чтобы не запрашивать их повторно ни в текущем, ни в следующих импортах.
+    Возвращает множество unti_id, которые не удалось получить в этом вызове
+    """
+    unti_ids = {i for i in unti_ids if i and i not in user_map and i not in failed_users}
+    if not unti_ids:
+        return set()
+    ttl = getattr(settings, 'SSO_PULL_FAILED_TTL', 600)
+    cached_failed = set()
+    if ttl:
+        keys = {SSO_PULL_FAILED_KEY.format(i): i for i in unti_ids}
+        cached_failed = {keys[key] for key in DEFAULT_CACHE.get_many(keys.keys())}
+    workers = getattr(settings, 'SSO_PULL_WORKERS', 8)
+    to_pull = unti_ids - cached_failed
+    if workers > 1 and len(to_pull) > 1:
+        futures = [sso_pull_executor.submit(i) for i in to_pull]
+        results = [future.result() for future in futures]
+    else:
+        results = [_pull_sso_user_with_retries(i) for i in to_pull]
+    failed = set(cached_failed)
+    for unti_id, user_id in results:
+        if user_id:
+            user_map[unti_id] = user_id
+        else:
+            failed.add(unti_id)
+    if ttl and failed - cached_failed:
+        DEFAULT_CACHE.set_many({SSO_PULL_FAILED_KEY.format(i): True for i in failed - cached_failed}, timeout=ttl)
+    failed_users.update(failed)
+    return failed
+
+
 def recalculate_user_chart_data(user):
     """
     обновление данных для чарта компетенций пользователя
@@ -607,7 +849,7 @@ def update_contexts():
                         uuid = event.get('uuid')
                         if uuid:
                             events.append(uuid)
-                Event.objects.filter(uid__in=events).update(context=c)
+                Event.objects.filter(uid__in=events).update(context=c, data_hash='')
     except ApiError:
         return
     except Exception:
@@ -625,6 +867,9 @@ def update_teams():
         unti_id_to_id = dict(User.objects.filter(unti_id__isnull=False).values_list('unti_id', 'id'))
         failed_unti_ids = set()
         for resp in PTApi().fetch_teams():
+            page_unti_ids = {u['unti_id'] for item in resp for u in item['users']}
+            for unti_id in pull_sso_users(page_unti_ids, unti_id_to_id, failed_unti_ids):
+                logging.error('User with unti_id %s not found', unti_id)
             for item in resp:
                 context_ids = set()
                 for ct in item['contexts']:
@@ -635,18 +880,9 @@ def update_teams():
                     context_ids.add(ct_id)
                 user_ids = set()
                 for u in item['users']:
-                    if u['unti_id'] in failed_unti_ids:
-                        continue
                     user_id = unti_id_to_id.get(u['unti_id'])
-                    if user_id is None:
-                        user = pull_sso_user(u['unti_id'])
-                        if not user:
-                            failed_unti_ids.add(u['unti_id'])
-                            logging.error('User with unti_id %s not found', u['unti_id'])
-                            continue
-                        unti_id_to_id[u['unti_id']] = user.id
-                        user_id = user.id
-                    user_ids.add(user_id)
+                    if user_id is not None:
+                        user_ids.add(user_id)
                 if not context_ids:
                     logging.error('PT team %s has no valid contexts', item['uuid'])
                     continue
@@ -668,23 +904,49 @@ def update_teams():
 
 
 def parse_model(data):
+    """
+    сохранение метамодели из ответа dp. Инструменты и компетенции метамодели обновляются, только если
+    хэш ответа отличается от сохраненного
+    """
     if isinstance(data, dict) and all([data.get(i) is not None for i in ['title', 'guid', 'uuid']]):
-        metamodel = MetaModel.objects.update_or_create(uuid=data['uuid'], defaults={
-            'guid': data['guid'], 'title': data['title']
-        })[0]
-        tools = []
-        schema = data.get('schema')
-        if schema and isinstance(schema, dict):
-            for item in schema.get('tool') or []:
-                if not isinstance(item, dict):
-                    continue
-                uuid = item.get('uuid')
-                title = item.get('title')
-                if uuid and title:
-                    tools.append(DpTool.objects.update_or_create(uuid=uuid, defaults={'title': title})[0])
-        metamodel.tools.set(tools)
-        parse_competences(data, metamodel, {})
+        data_hash = get_data_hash(data)
+        with transaction.atomic():
+            metamodel, created = MetaModel.objects.update_or_create(uuid=data['uuid'], defaults={
+                'guid': data['guid'], 'title': data['title'], 'fetched_at': timezone.now()
+            })
+            if not created and metamodel.data_hash == data_hash:
+                return metamodel
+            tools = []
+            schema = data.get('schema')
+            if schema and isinstance(schema, dict):
+                for item in schema.get('tool') or []:
+                    if not isinstance(item, dict):
+                        continue
+                    uuid = item.get('uuid')
+                    title = item.get('title')
+                    if uuid and title:
+                        tools.append(DpTool.objects.update_or_create(uuid=uuid, defaults={'title': title})[0])
+            metamodel.tools.set(tools)
+            parse_competences(data, metamodel, {})
+            metamodel.data_hash = data_hash
+            MetaModel.objects.filter(id=metamodel.id).update(data_hash=data_hash)
+        return metamodel
+
+
+def fetch_metamodel(uuid, handler=None):
+    """
+    получение метамодели из dp. Если метамодель уже запрашивалась менее METAMODEL_CACHE_TTL секунд назад,
+    возвращается сохраненный объект без запроса к dp. Если указан handler, метамодели с другим обработчиком
+    не сохраняются
+    """
+    metamodel = MetaModel.objects.filter(uuid=uuid).first()
+    ttl = getattr(settings, 'METAMODEL_CACHE_TTL', 3600)
+    if metamodel and metamodel.fetched_at and metamodel.fetched_at > timezone.now() - timedelta(seconds=ttl):
         return metamodel
+    data = DpApi().get_metamodel(uuid)
+    if handler and data.get('handler') != handler:
+        return
+    return parse_model(data)
 
 
 def update_metamodels():
@@ -700,11 +962,8 @@ def update_metamodels():
         return
     for model_uuid in model_uuids:
         try:
-            data = DpApi().get_metamodel(model_uuid)
-            if data.get('handler') != 'BigWheel':
-                # размечать цс можно только по "колесным" моделям
-                continue
-            parse_model(data)
+            # размечать цс можно только по "колесным" моделям
+            fetch_metamodel(model_uuid, handler='BigWheel')
         except Exception:
             logging.exception('Failed to fetch metamodel %s', model_uuid)
 
@@ -772,6 +1031,71 @@ def check_mysql_connection():
         logging.exception('Mysql check failed')
 
 
+class EventMaterialsBatch:
+    """
+    материалы пачки мероприятий для csv выгрузки, загруженные фиксированным количеством запросов независимо
+    от числа мероприятий и материалов: персональные и командные материалы вместе с результатами, блоками,
+    элементами колеса и конспектами, материалы мероприятий, команды с участниками и участники мероприятий
+    """
+    def __init__(self, events):
+        ids = [event.id for event in events]
+        self.personal = self._group_by_event(
+            EventMaterial.objects.filter(event_id__in=ids)
+            .select_related('result_v2', 'result_v2__result', 'result_v2__result__block', 'user', 'summary')
+            .prefetch_related('result_v2__circle_items')
+        )
+        self.team = self._group_by_event(
+            EventTeamMaterial.objects.filter(event_id__in=ids)
+            .select_related('result_v2', 'result_v2__result', 'result_v2__result__block', 'summary')
+            .prefetch_related('result_v2__circle_items')
+        )
+        self.event = self._group_by_event(EventOnlyMaterial.objects.filter(event_id__in=ids).select_related('summary'))
+        team_ids = {m.team_id for materials in self.team.values() for m in materials}
+        self.teams = {team.id: team for team in Team.objects.filter(id__in=team_ids).prefetch_related('users')}
+        self.participants = defaultdict(set)
+        if any(team.system != Team.SYSTEM_UPLOADS for team in self.teams.values()):
+            # участники мероприятий нужны только для команд не из uploads
+            for event_id, user_id in EventEntry.objects.filter(event_id__in=ids).values_list('event_id', 'user_id'):
+                self.participants[event_id].add(user_id)
+            run_events = defaultdict(list)
+            for event in events:
+                if event.run_id:
+                    run_events[event.run_id].append(event.id)
+            for run_id, user_id in RunEnrollment.objects.filter(run_id__in=run_events).values_list('run_id', 'user_id'):
+                for event_id in run_events[run_id]:
+                    self.participants[event_id].add(user_id)
+
+    @staticmethod
+    def _group_by_event(qs):
+        result = defaultdict(list)
+        for m in qs.order_by('id'):
+            result[m.event_id].append(m)
+        return result
+
+    def get_team_members(self, team_id, event):
+        team = self.teams[team_id]
+        if team.system == Team.SYSTEM_UPLOADS:
+            return list(team.get_members_for_event(event))
+        user_ids = self.participants[event.id]
+        return [user for user in team.users.all() if user.id in user_ids]
+
+
+class RowTemplate:
+    """
+    скомпилированный шаблон строки выгрузки: порядок полей и переведенные заголовки вычисляются один раз
+    на выгрузку, строки - списки фиксированной длины, в которые значения пишутся по позициям из columns,
+    например, row[template.columns.unti_id] = 1
+    """
+    def __init__(self, field_names):
+        self.keys = tuple(field_names)
+        self.headers = tuple(str(i) for i in field_names.values())
+        self.columns = SimpleNamespace(**{key: pos for pos, key in enumerate(self.keys)})
+        self.empty = [''] * len(self.keys)
+
+    def new(self):
+        return self.empty.copy()
+
+
 class EventMaterialsCSV:
     """
     класс, генерирующий строки для csv выгрузки всех файлов мероприятия
@@ -783,7 +1107,9 @@ class EventMaterialsCSV:
 
     def __init__(self, event):
         self.event = event
+        self.batch = None
         self.teams_data_cache = {}
+        self.event_line = None
         self.model_names = dict(MetaModel.objects.values_list('uuid', 'title'))
         self.competence_names = dict(DpCompetence.objects.values_list('uuid', 'title'))
 
@@ -819,37 +1145,36 @@ class EventMaterialsCSV:
             ('lines_num', _('Количество строк с файлом')),
         ])
 
+    @cached_property
+    def row_template(self):
+        return RowTemplate(self.field_names())
+
     def default_line(self):
-        d = OrderedDict([(k, '') for k in self.field_names()])
-        self.populate_common_data(d)
-        return d
+        """
+        строка с общими данными мероприятия, которые заполняются один раз на мероприятие
+        """
+        if self.event_line is None or self.event_line[0] is not self.event:
+            d = self.row_template.new()
+            self.populate_common_data(d)
+            self.event_line = (self.event, d)
+        return self.event_line[1].copy()
 
     def generate_headers(self):
-        return self.field_names().values()
+        return self.row_template.headers
 
     def generate(self):
         yield self.generate_headers()
+        self.batch = EventMaterialsBatch([self.event])
         for line in self.generate_for_event():
             yield line
 
     def generate_for_event(self):
-        personal_materials = EventMaterial.objects.filter(event=self.event).\
-            select_related('result_v2', 'result_v2__result', 'result_v2__result__block', 'user').\
-            prefetch_related('result_v2__result__circle_items')
-        team_materials = EventTeamMaterial.objects.filter(event=self.event).\
-            select_related('result_v2', 'result_v2__result', 'result_v2__result__block').\
-            prefetch_related('result_v2__result__circle_items')
-        event_materials = EventOnlyMaterial.objects.filter(event=self.event)
-
-        for m in personal_materials.iterator():
-            for line in self.lines_for_personal_material(m):
-                yield line.values()
-        for m in team_materials.iterator():
-            for line in self.lines_for_team_material(m):
-                yield line.values()
-        for m in event_materials.iterator():
-            for line in self.lines_for_event_material(m):
-                yield line.values()
+        for m in self.batch.personal[self.event.id]:
+            yield from self.lines_for_personal_material(m)
+        for m in self.batch.team[self.event.id]:
+            yield from self.lines_for_team_material(m)
+        for m in self.batch.event[self.event.id]:
+            yield from self.lines_for_event_material(m)
 
     def lines_for_personal_material(self, m):
         default = self.default_line()
@@ -858,7 +1183,7 @@ class EventMaterialsCSV:
         self.populate_result_data(default, m)
         meta = self.get_meta(m)
         meta_objects_num = max(len(meta), 1)
-        default['lines_num'] = meta_objects_num
+        default[self.row_template.columns.lines_num] = meta_objects_num
         if meta:
             for item in meta:
                 line = default.copy()
@@ -874,11 +1199,10 @@ class EventMaterialsCSV:
         meta = self.get_meta(m)
         meta_objects_num = max(len(meta), 1)
         team_data = self._get_team_data(m.team_id)
-        default.update({
-            'lines_num': meta_objects_num * len(team_data['members']),
-            'team_id': m.team_id,
-            'team_title': team_data['title'],
-        })
+        c = self.row_template.columns
+        default[c.lines_num] = meta_objects_num * len(team_data['members'])
+        default[c.team_id] = m.team_id
+        default[c.team_title] = team_data['title']
         for user in team_data['members']:
             user_line = default.copy()
             self.populate_user_data(user_line, user)
@@ -893,53 +1217,48 @@ class EventMaterialsCSV:
     def lines_for_event_material(self, m):
         default = self.default_line()
         self.populate_material_data(default, m, self.TYPE_EVENT)
-        default['lines_num'] = 1
+        default[self.row_template.columns.lines_num] = 1
         yield default
 
     def populate_common_data(self, d):
-        d.update({
-            'title': self.event.title,
-            'dt_start': self.dt_start,
-            'dt_end': self.dt_end,
-        })
+        c = self.row_template.columns
+        d[c.title] = self.event.title
+        d[c.dt_start] = self.dt_start
+        d[c.dt_end] = self.dt_end
 
     def populate_material_data(self, d, m, material_type):
-        d.update({
-            'initiator': m.initiator or '',
-            'file_url': m.get_url(),
-            'file_extension': m.get_extension(),
-            'comment': self.get_comment(m, material_type),
-            'type': self.get_type(material_type),
-            'summary_content': m.summary.content if m.summary_id else '',
-        })
+        c = self.row_template.columns
+        d[c.initiator] = m.initiator or ''
+        d[c.file_url] = m.get_url()
+        d[c.file_extension] = m.get_extension()
+        d[c.comment] = self.get_comment(m, material_type)
+        d[c.type] = self.get_type(material_type)
+        d[c.summary_content] = m.summary.content if m.summary_id else ''
 
     def populate_user_data(self, d, user):
-        d.update({
-            'unti_id': user.unti_id or '',
-            'leader_id': user.leader_id or '',
-            'last_name': user.last_name,
-            'first_name': user.first_name,
-            'second_name': user.second_name,
-        })
+        c = self.row_template.columns
+        d[c.unti_id] = user.unti_id or ''
+        d[c.leader_id] = user.leader_id or ''
+        d[c.last_name] = user.last_name
+        d[c.first_name] = user.first_name
+        d[c.second_name] = user.second_name
 
     def populate_result_data(self, d, m):
-        d.update({
-            'block_title': m.result_v2 and m.result_v2.result.block.title or '',
-            'result_title': m.result_v2 and m.result_v2.result.title or '',
-            'meta_type': m.result_v2 and m.result_v2.result.block.block_type,
-            'meta_activity': m.result_v2 and m.result_v2.result.block.description,
-            'approved': str(m.result_v2.approved),
-        })
+        c = self.row_template.columns
+        d[c.block_title] = m.result_v2 and m.result_v2.result.block.title or ''
+        d[c.result_title] = m.result_v2 and m.result_v2.result.title or ''
+        d[c.meta_type] = m.result_v2 and m.result_v2.result.block.block_type
+        d[c.meta_activity] = m.result_v2 and m.result_v2.result.block.description
+        d[c.approved] = str(m.result_v2.approved)
 
     def populate_meta(self, d, meta_item):
-        d.update({
-            'sector': meta_item.get('sector', ''),
-            'level': meta_item.get('level', ''),
-            'sublevel': meta_item.get('sublevel', ''),
-            'meta_instruments': self.format_tools(meta_item.get('tools')),
-            'meta_model': self.model_names.get(meta_item.get('model'), ''),
-            'meta_sector_name': self.competence_names.get(meta_item.get('competence'), ''),
-        })
+        c = self.row_template.columns
+        d[c.sector] = meta_item.get('sector', '')
+        d[c.level] = meta_item.get('level', '')
+        d[c.sublevel] = meta_item.get('sublevel', '')
+        d[c.meta_instruments] = self.format_tools(meta_item.get('tools'))
+        d[c.meta_model] = self.model_names.get(meta_item.get('model'), '')
+        d[c.meta_sector_name] = self.competence_names.get(meta_item.get('competence'), '')
 
     def format_tools(self, tools):
         if tools:
@@ -979,8 +1298,10 @@ class EventMaterialsCSV:
 
     def _get_team_data(self, team_id):
         if team_id not in self.teams_data_cache:
-            team = Team.objects.prefetch_related('users').get(id=team_id)
-            team_data = {'members': list(team.get_members_for_event(self.event)), 'title': team.name}
+            team_data = {
+                'members': self.batch.get_team_members(team_id, self.event),
+                'title': self.batch.teams[team_id].name,
+            }
             self.teams_data_cache[team_id] = team_data
         return self.teams_data_cache[team_id]
 
@@ -1004,15 +1325,24 @@ class EventGroupMaterialsCSV(EventMaterialsCSV):
 
     def populate_common_data(self, d):
         super().populate_common_data(d)
-        d.update({'event_uuid': self.event.uid})
-
-    def generate(self):
-        yield self.generate_headers()
-        for event in self.events_qs:
-            self.event = event
-            self.teams_data_cache = {}
-            for line in self.generate_for_event():
-                yield line
+        d[self.row_template.columns.event_uuid] = self.event.uid
+
+    def generate(self, with_headers=True):
+        """
+        мероприятия обрабатываются пачками по CSV_EXPORT_EVENTS_CHUNK_SIZE, материалы каждой пачки загружаются
+        сразу для всех ее мероприятий, строки выдаются в том же порядке, что и при обработке по одному.
+        with_headers=False используется для частей выгрузки, собираемых потом в один файл
+        """
+        if with_headers:
+            yield self.generate_headers()
+        for events in iter_batches(self.events_qs.iterator(), getattr(settings, 'CSV_EXPORT_EVENTS_CHUNK_SIZE', 100)):
+            events = list(events)
+            self.batch = EventMaterialsBatch(events)
+            for event in events:
+                self.event = event
+                self.teams_data_cache = {}
+                for line in self.generate_for_event():
+                    yield line
 
     def get_csv_filename(self, do_quote=True):
         f = quote if do_quote else lambda x: x
@@ -1066,16 +1396,19 @@ def update_casbin_data(update_rule=None):
         defaults = {
             'model': data['model'],
             'policy': data['policy'],
+            'checksum': CasbinData.get_checksum(data['model'], data['policy']),
         }
         CasbinData.objects.update_or_create(id=1, defaults=defaults)
         if not update_rule:
             # если обновилась модель, увеличивается номер ее версии, кэш для старой версии считается недействительным
             CasbinData.objects.filter(id=1).update(model_version=models.F('model_version') + 1)
+        # остальные процессы подхватят новые данные при очередной сверке версии и контрольной суммы
+        enforcer_registry.swap(CasbinData.objects.get(id=1))
 
         if update_rule and update_rule.startswith('p'):
             # удаление прав всех пользователей для контекста
             ctx_uuid = update_rule.strip().split(',')[2].strip()
-            UserContextAssistantCache().discard_many((user, ctx_uuid) for user in User.objects.iterator())
+            UserContextAssistantCache.discard_context(ctx_uuid)
         elif update_rule and update_rule.startswith('g'):
             # удаление прав одного пользователя в контексте
             unti_id = update_rule.strip().split(',')[1].strip()
@@ -1091,8 +1424,19 @@ def update_casbin_data(update_rule=None):
 
 
 class XLSWriter:
-    def __init__(self, f):
-        self.workbook = xlsxwriter.Workbook(f)
+    """
+    запись строк в xlsx. В режиме constant_memory (по умолчанию XLSX_CONSTANT_MEMORY) каждая законченная строка
+    сбрасывается во временный файл в каталоге XLSX_TMP_DIR (или системном временном каталоге), так что в памяти
+    держится только текущая строка. Строки при этом должны записываться по порядку
+    """
+    def __init__(self, f, constant_memory=None, tmpdir=None):
+        if constant_memory is None:
+            constant_memory = getattr(settings, 'XLSX_CONSTANT_MEMORY', True)
+        options = {'constant_memory': constant_memory}
+        tmpdir = tmpdir or getattr(settings, 'XLSX_TMP_DIR', None)
+        if tmpdir:
+            options['tmpdir'] = tmpdir
+        self.workbook = xlsxwriter.Workbook(f, options)
         self.worksheet = self.workbook.add_worksheet()
         self.current_row = 0
 
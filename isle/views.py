@@ -4,6 +4,7 @@ import functools
 import json
 import logging
 import os
+import tempfile
 from functools import wraps
 from collections import defaultdict, Counter
 from urllib.parse import quote
@@ -43,16 +44,17 @@ from rest_framework.views import APIView
 from social_django.models import UserSocialAuth
 from isle.api import LabsApi, XLEApi, DpApi, SSOApi
 from isle.cache import get_user_available_contexts
-from isle.filters import LabsUserResultFilter, LabsTeamResultFilter, StatisticsFilter
+from isle.filters import LabsUserResultFilter, LabsTeamResultFilter, StatisticsFilter, SyncRunFilter
 from isle.forms import CreateTeamForm, AddUserForm, EventMaterialForm, EditTeamForm, EventDTraceFilter, \
     EventDTraceAdminFilter, ResultStructureFormset, get_available_sublevels
 from isle.kafka import send_object_info, KafkaActions, check_kafka
 from isle.models import Event, EventEntry, EventMaterial, User, Trace, Team, EventTeamMaterial, EventOnlyMaterial, \
     Attendance, Activity, ActivityEnrollment, EventBlock, BlockType, UserResult, TeamResult, UserRole, ApiUserChart, \
     LabsEventResult, LabsUserResult, LabsTeamResult, Context, CSVDump, PLEUserResult, RunEnrollment, DTraceStatistics, \
-    CircleItem, Summary, MetaModel, DpTool, DpCompetence, ModelCompetence
+    CircleItem, Summary, MetaModel, DpTool, DpCompetence, ModelCompetence, SyncRun
 from isle.serializers import AttendanceSerializer, LabsUserResultSerializer, LabsTeamResultSerializer, \
-    UserFileSerializer, UserResultSerializer, EventOnlyMaterialSerializer, DTraceStatisticsSerializer
+    UserFileSerializer, UserResultSerializer, EventOnlyMaterialSerializer, DTraceStatisticsSerializer, \
+    SyncRunSerializer
 from isle.tasks import generate_events_csv, team_members_set_changed, handle_ple_user_result
 from isle.utils import get_allowed_event_type_ids, \
     recalculate_user_chart_data, get_results_list, get_release_version, check_mysql_connection, \
@@ -367,8 +369,13 @@ class EventView(GetEventMixin, TemplateView):
 
     @staticmethod
     def get_teams_data(event, user, users):
-        teams = list(Team.objects.filter(event=event).select_related('creator').prefetch_related('users')) + \
+        teams = list(Team.objects.filter(event=event).select_related('creator', 'event__context')
+                     .prefetch_related('users')) + \
                 list(event.get_pt_teams(user_ids=[i.id for i in users]))
+        if user.is_authenticated and event.context_id:
+            # все команды страницы относятся к мероприятию event, право в его контексте проверяется один раз,
+            # дальше используется запомненное значение
+            user.is_assistant_for_contexts([event.context])
         user_teams = [
             i.id for i in teams if user in
                                    i.get_members_for_event(event, user_ids=[i.id for i in users])
@@ -1494,6 +1501,7 @@ class RemoveUserFromEvent(GetEventMixin, View):
                           EventTeamMaterial.objects.filter(event=self.event, team__users__id=user_id).exists()
             return JsonResponse({'can_delete': True, 'has_results': has_results, 'user_id': user_id})
         EventEntry.objects.filter(event=self.event, user_id=request.POST.get('user_id')).update(deleted=True)
+        Event.touch_materials([self.event.id])
         Attendance.objects.filter(event=self.event, user_id=request.POST.get('user_id')).delete()
         logging.warning('User %s removed user %s from event %s' %
                         (request.user.username, entry.user.username, entry.event.uid))
@@ -1546,7 +1554,7 @@ class EventItemAutocompleteBase(autocomplete.Select2QuerySetView):
     def get_queryset(self):
         exclude = self.forwarded.get('exclude') or []
         event_id = str(self.forwarded.get('event'))
-        event = Event.objects.get(id=event_id)
+        event = Event.objects.select_related('context').get(id=event_id)
         if not event_id.isdigit() or not (self.request.user.is_authenticated and self.request.user.is_assistant_for_context(event.context)):
             return self.model.objects.none()
         return self.model.objects.filter(**self.get_filters(event_id)).exclude(id__in=exclude)
@@ -2605,13 +2613,14 @@ class CSVResponseGeneratorMixin:
 
 class XLSResponseGeneratorMixin:
     def get_xls_response(self, obj):
-        out = io.BytesIO()
+        # файл собирается на диске и отдается по частям, FileResponse закроет (и тем самым удалит) его сам
+        out = tempfile.TemporaryFile(dir=getattr(settings, 'XLSX_TMP_DIR', None))
         writer = XLSWriter(out)
         for row in obj.generate():
             writer.writerow(row)
         writer.close()
         out.seek(0)
-        resp = FileResponse(out)
+        resp = FileResponse(out, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         resp['Content-Disposition'] = "attachment; filename*=UTF-8''{}.xlsx".format(obj.get_csv_filename())
         return resp
 
@@ -2662,15 +2671,27 @@ class BaseCsvEventsDataView(ChooseFormatResponseGeneratorMixin, View):
             })
         if num <= settings.MAX_MATERIALS_FOR_SYNC_GENERATION:
             return self.get_response(obj)
-        if CSVDump.current_generations_for_user(request.user) >= settings.MAX_PARALLEL_CSV_GENERATIONS:
-            raise PermissionDenied
         task_meta = meta_data.copy()
         task_meta['activity'] = activity_filter and activity_filter.id
         task_meta['context'] = request.user.chosen_context and request.user.chosen_context.id
+        event_ids = [i.id for i in events]
+        cache_key = CSVDump.get_cache_key(task_meta, event_ids)
+        cached_dump = CSVDump.get_cached(cache_key, event_ids)
+        if cached_dump:
+            # материалы не менялись с момента генерации такой же выгрузки, файл переиспользуется. Время
+            # готовности берется из исходной выгрузки, чтобы копии не продлевали срок ее переиспользования
+            csv_dump = CSVDump.objects.create(
+                owner=request.user, header=cached_dump.header, meta_data=task_meta, cache_key=cache_key,
+                csv_file=cached_dump.csv_file.name, status=CSVDump.STATUS_COMPLETE,
+                datetime_ready=cached_dump.datetime_ready
+            )
+            return JsonResponse({'page_url': reverse('csv-dumps-list'), 'dump_id': csv_dump.id})
+        if CSVDump.current_generations_for_user(request.user) >= settings.MAX_PARALLEL_CSV_GENERATIONS:
+            raise PermissionDenied
         csv_dump = CSVDump.objects.create(
-            owner=request.user, header=obj.get_csv_filename(do_quote=False), meta_data=task_meta
+            owner=request.user, header=obj.get_csv_filename(do_quote=False), meta_data=task_meta, cache_key=cache_key
         )
-        generate_events_csv.delay(csv_dump.id, [i.id for i in events], request.GET.get('format'), task_meta)
+        generate_events_csv.delay(csv_dump.id, event_ids, request.GET.get('format'), task_meta)
         return JsonResponse({'page_url': reverse('csv-dumps-list'), 'dump_id': csv_dump.id})
 
     def get_events_for_csv(self):
@@ -3164,6 +3185,66 @@ class ContextUserStatistics(ListAPIView):
         return super().list(request, *args, **kwargs)
 
 
+class SyncRunsApi(ListAPIView):
+    """
+    **Описание**
+
+        Журнал запусков синхронизации данных, последние запуски первыми
+
+    **Пример запроса**
+
+        GET /api/sync-runs/?name=dwh:event_structure&started_at_after=2019-11-01T00:00:00&limit=10
+
+    **Параметры запроса**
+
+        * name - название синхронизации, необязательный параметр
+        * status - статус запуска (running, ok, failed), необязательный параметр
+        * started_at_after - минимальное время начала в iso формате, необязательный параметр
+        * started_at_before - максимальное время начала в iso формате, необязательный параметр
+        * limit - максимальное количество запусков на странице
+        * offset
+
+    **Пример ответа**
+
+        * 200 успешно
+            {
+                "count": 1,
+                "next": null,
+                "previous": null,
+                "results": [
+                    {
+                        "id": 1,
+                        "name": "dwh:event_structure",
+                        "status": "ok",
+                        "started_at": "2019-11-28T14:00:00.123456+03:00",
+                        "finished_at": "2019-11-28T14:00:12.654321+03:00",
+                        "duration": 12.530865,
+                        "watermark_from": "2019-11-28T13:55:00.000000+03:00",
+                        "watermark_to": "2019-11-28T14:00:00.123456+03:00",
+                        "rows_read": 1520,  // прочитано строк из источника
+                        "inserted": 12,
+                        "updated": 40,
+                        "skipped": 1468,  // строки без изменений
+                        "http_calls": 0,  // запросы к внешним api
+                        "db_queries": 85,  // запросы к базе uploads
+                        "errors": 0,
+                        "last_error": ""
+                    }
+                ]
+            }
+
+        * 403 если не указан хедер X-API-KEY или ключ неверен
+    """
+    permission_classes = (ApiPermission, )
+    serializer_class = SyncRunSerializer
+    pagination_class = CustomLimitOffsetPagination
+    filter_backends = (django_filters.rest_framework.DjangoFilterBackend,)
+    filterset_class = SyncRunFilter
+
+    def get_queryset(self):
+        return SyncRun.objects.order_by('-started_at')
+
+
 class EventDigitalTrace(GetEventMixin, TemplateView):
     """
     страница цс мероприятия
@@ -3309,7 +3390,7 @@ class TeamAndUserAutocomplete(Select2QuerySetSequenceView):
     def get_queryset(self):
         event_id = self.forwarded.get('event')
         try:
-            event = Event.objects.get(id=event_id)
+            event = Event.objects.select_related('context').get(id=event_id)
         except (Event.DoesNotExist, ValueError, TypeError):
             raise Http404
         obj_type = self.forwarded.get('type')
@@ -160,14 +160,31 @@ SOCIAL_AUTH_UNTI_SECRET = ''
 CONNECTION_TIMEOUT = 20
 # таймаут для head запроса к файлу
 HEAD_REQUEST_CONNECTION_TIMEOUT = 5
+# пул keep-alive соединений api клиентов: количество хостов, соединений на хост, ожидание свободного соединения
+# вместо открытия нового сверх лимита, количество повторов идемпотентных запросов и коэффициент задержки между ними
+API_POOL_CONNECTIONS = 10
+API_POOL_MAXSIZE = 10
+API_POOL_BLOCK = True
+API_RETRIES = 2
+API_RETRY_BACKOFF = 0.3
 LABS_URL = ''
 LABS_TOKEN = ''
+# количество страниц ответа labs, запрашиваемых одновременно (0 - страницы запрашиваются последовательно)
+LABS_PARALLEL_PAGES = 0
+# разбор активностей из ответа labs по одной вместо загрузки страницы целиком (в памяти держится одна
+# активность) и количество активностей, после которого сохраняются собранные по ним авторы и хэши
+LABS_STREAM_ACTIVITIES = False
+LABS_STREAM_BATCH_SIZE = 100
 
 XLE_URL = ''
 XLE_TOKEN = ''
+# количество страниц ответа xle, запрашиваемых одновременно (0 - страницы запрашиваются последовательно)
+XLE_PARALLEL_PAGES = 0
 
 DP_URL = ''
 DP_TOKEN = ''
+# время в секундах, в течение которого метамодель из dp не запрашивается повторно
+METAMODEL_CACHE_TTL = 3600
 
 PT_URL = ''
 PT_TOKEN = ''
@@ -219,6 +236,35 @@ XLE_RUN_ENROLLMENT_DELETE_CHECK_TIME = 24
 CELERY_RESULT_BACKEND = 'django-db'
 DJANGO_CELERY_RESULTS_TASK_ID_MAX_LENGTH = 191
 
+# как часто (в секундах) процесс сверяет версию модели и контрольную сумму политик casbin с базой
+CASBIN_ENFORCER_CHECK_INTERVAL = 5
+
+# размер пачки объектов при массовом сохранении данных из внешних систем
+BULK_UPSERT_CHUNK_SIZE = 1000
+
+# количество строк, читаемых за раз из серверного курсора при запросах к DWH
+DWH_FETCH_BATCH_SIZE = 5000
+# каталог для временных файлов, в которые результат запроса к DWH читается до начала обработки
+DWH_SPOOL_DIR = None
+
+# максимальное количество значений в условии in запросов к DWH
+DWH_IN_CHUNK_SIZE = 1000
+
+# количество шагов синхронизации с DWH, выполняемых одновременно
+DWH_SYNC_WORKERS = 4
+
+# максимальное количество свободных соединений с каждой базой DWH, хранящихся в пуле
+DWH_POOL_SIZE = 4
+
+# параллельное пропушивание пользователей из sso при импортах: количество потоков, количество повторов запроса,
+# пауза перед повтором (умножается на номер попытки) и время (в секундах), в течение которого не найденный
+# пользователь повторно не запрашивается. Пул потоков общий для процесса, так что синхронизация с DWH
+# использует не больше DWH_SYNC_WORKERS + SSO_PULL_WORKERS + 1 соединений с базой
+SSO_PULL_WORKERS = 8
+SSO_PULL_RETRIES = 1
+SSO_PULL_RETRY_DELAY = 0.5
+SSO_PULL_FAILED_TTL = 600
+
 # интервал автосохранения конспектов в миллисекундах
 SUMMARY_SAVE_INTERVAL = 60000
 
@@ -236,6 +282,17 @@ BLEACH_ALLOWED_ATTRIBUTES = {
 
 DEFAULT_CSV_ENCODING = 'utf-8'
 CSV_ENCODING_FOR_OS = {}
+# количество мероприятий, материалы которых загружаются вместе при выгрузке по нескольким мероприятиям
+CSV_EXPORT_EVENTS_CHUNK_SIZE = 100
+# количество мероприятий в одной части асинхронной выгрузки, части генерируются параллельно и затем
+# собираются в один файл. 0 - генерация одной задачей
+CSV_EXPORT_SHARD_SIZE = 500
+# время в секундах, в течение которого готовая асинхронная выгрузка отдается повторно при тех же параметрах,
+# если материалы мероприятий не менялись. 0 - не использовать готовые выгрузки
+CSV_EXPORT_CACHE_TTL = 24 * 3600
+# построчная запись xlsx через временные файлы вместо хранения всей таблицы в памяти
+XLSX_CONSTANT_MEMORY = True
+XLSX_TMP_DIR = None
 
 DEFAULT_TRACE_DATA_JSON = [
    {